@@ -0,0 +1,173 @@
+import argparse
+import contextlib
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+from google.auth.credentials import AnonymousCredentials
+
+from body_cache import BodyCache
+from fake_apis import FakeGoogleCalendar, FakeNotion
+from google_calender import Google
+from main import sync_cycle
+from notion import Notion
+from rate_limit import RequestScheduler
+from sync_state import SyncState
+from utilities import setup_logging
+
+# what a --once run imports before its probe, and with what it imports on top once a pair needs a cycle
+STARTUP_IMPORTS = {
+    "idle --once": "import main",
+    "with the Google client": "import main, google_credentials, apiclient.discovery, googleapiclient.http"
+}
+
+
+# runs sync cycles against local stand-ins of Notion and Google calendar and reports what they cost
+def run_benchmark(size, cycles, edits, latency, server_rate_limit, notion_rate, google_rate, workers):
+    notion_server = FakeNotion(size=size, latency=latency, rate_limit=server_rate_limit).start()
+    google_server = FakeGoogleCalendar(latency=latency, rate_limit=server_rate_limit).start()
+
+    results = []
+    with tempfile.TemporaryDirectory() as folder, quiet():
+        state = SyncState(state_location=os.path.join(folder, "sync_state.db"))
+        scheduler = RequestScheduler(notion_rate=notion_rate, google_rate=google_rate)
+
+        notion = Notion(user_secret="benchmark",
+                        database_id=notion_server.database_id,
+                        title_header="Task",
+                        date_header="Due",
+                        message_id_header="Message_ID",
+                        body_cache=BodyCache(max_size=size),
+                        scheduler=scheduler,
+                        api_url=notion_server.api_url,
+                        write_queue=state)
+        notion.start_writes()
+        google = Google(calender_name="notion",
+                        scheduler=scheduler,
+                        credentials=AnonymousCredentials(),
+                        api_root=google_server.url)
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for cycle in range(cycles):
+                # the first cycle creates every event, the later ones only see a few edits
+                if cycle > 0:
+                    notion_server.edit_pages(edits)
+
+                notion_server.requests.clear()
+                google_server.requests.clear()
+                notion_server.bytes_sent = google_server.bytes_sent = 0
+
+                tracemalloc.start()
+                started = time.perf_counter()
+                sync_cycle(google, notion, state, pool, incremental_sync=True, full_sync_interval=3600)
+                duration = time.perf_counter() - started
+                # the Message_ID writes go on after the cycle, they still count towards its requests
+                notion.flush_writes()
+                peak_memory = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+
+                results.append({"cycle": cycle,
+                                "duration": duration,
+                                "peak_memory": peak_memory,
+                                "requests": notion_server.requests + google_server.requests,
+                                "received": notion_server.bytes_sent + google_server.bytes_sent})
+        notion.stop_writes()
+        state.close()
+
+    notion_server.stop()
+    google_server.stop()
+    return results
+
+
+def report(size, results):
+    print(f"\n{size} pages")
+    print(f"{'cycle':>6} {'seconds':>9} {'peak MB':>8} {'recv KB':>8} {'notion':>7} {'google':>7}  requests")
+    for result in results:
+        requests = result["requests"]
+        notion_requests = sum(count for name, count in requests.items() if name.startswith("notion"))
+        google_requests = sum(count for name, count in requests.items() if name.startswith("google"))
+        detail = ", ".join(f"{name}={count}" for name, count in sorted(requests.items()))
+        print(f"{result['cycle']:>6} {result['duration']:>9.3f} {result['peak_memory'] / 2 ** 20:>8.1f} "
+              f"{result['received'] / 2 ** 10:>8.1f} "
+              f"{notion_requests:>7} {google_requests:>7}  {detail}")
+
+    # the first cycle is the cold one, the percentiles describe the steady state
+    durations = sorted(result["duration"] for result in results[1:])
+    if durations:
+        print(f"warm cycles: p50 {percentile(durations, 50):.3f}s, p95 {percentile(durations, 95):.3f}s, "
+              f"max {durations[-1]:.3f}s, mean {statistics.mean(durations):.3f}s")
+
+
+# a fresh interpreter for every run, so nothing is imported yet, keeps the fastest of 'runs' and its peak memory
+def measure_startup(runs):
+    results = {}
+    for name, imports in STARTUP_IMPORTS.items():
+        code = f"{imports}\nimport resource\nprint(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)"
+        fastest = None
+        for _ in range(runs):
+            started = time.perf_counter()
+            output = subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                    capture_output=True, text=True, check=True).stdout
+            duration = time.perf_counter() - started
+            # ru_maxrss is in KB on Linux
+            if fastest is None or duration < fastest[0]:
+                fastest = (duration, int(output.split()[-1]) * 2 ** 10)
+        results[name] = fastest
+    return results
+
+
+def report_startup(results):
+    print("\nstartup")
+    print(f"{'':<24} {'seconds':>9} {'peak MB':>8}")
+    for name, (duration, peak_memory) in results.items():
+        print(f"{name:<24} {duration:>9.3f} {peak_memory / 2 ** 20:>8.1f}")
+
+
+def percentile(values, percent):
+    index = min(len(values) - 1, max(0, round(percent / 100 * len(values)) - 1))
+    return values[index]
+
+
+# the sync logs a summary per cycle, which would drown the report, errors are still shown
+@contextlib.contextmanager
+def quiet():
+    setup_logging(level="ERROR")
+    try:
+        yield
+    finally:
+        setup_logging()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure sync cycles against local fake Notion and Google apis.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000],
+                        help="number of pages in the fake database, up to 10000")
+    parser.add_argument("--cycles", type=int, default=5, help="cycles per size, the first one is cold")
+    parser.add_argument("--edits", type=int, default=5, help="pages edited between cycles")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument("--server-rate-limit", type=int, default=None,
+                        help="requests per second the fake servers allow before answering with a rate limit")
+    parser.add_argument("--notion-rate", type=float, default=1000, help="requests per second sent to Notion")
+    parser.add_argument("--google-rate", type=float, default=1000, help="requests per second sent to Google")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--startup-runs", type=int, default=3,
+                        help="fresh interpreters started to measure the startup, 0 skips it")
+    args = parser.parse_args()
+
+    if args.startup_runs > 0:
+        report_startup(measure_startup(args.startup_runs))
+
+    for dataset_size in args.sizes:
+        report(dataset_size, run_benchmark(size=dataset_size,
+                                           cycles=args.cycles,
+                                           edits=args.edits,
+                                           latency=args.latency,
+                                           server_rate_limit=args.server_rate_limit,
+                                           notion_rate=args.notion_rate,
+                                           google_rate=args.google_rate,
+                                           workers=args.workers))
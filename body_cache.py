@@ -0,0 +1,43 @@
+import threading
+from collections import OrderedDict
+
+
+class BodyCache:
+    def __init__(self, max_size=1000, state=None):
+        self.__MAX_SIZE = max_size
+        # SyncState used to keep the bodies across restarts, None keeps them only in memory
+        self.__State = state
+
+        self.__Lock = threading.Lock()
+        self.__Bodies = OrderedDict()
+
+    # the cached body of the page, or None if the page was edited since it was cached
+    def get(self, page_id: str, last_edited: str):
+        with self.__Lock:
+            cached = self.__Bodies.get(page_id)
+            if cached is not None and cached[0] == last_edited:
+                self.__Bodies.move_to_end(page_id)
+                return cached[1]
+
+        if self.__State is None:
+            return None
+
+        body_text = self.__State.get_body(page_id, last_edited)
+        if body_text is not None:
+            self.__remember(page_id, last_edited, body_text)
+        return body_text
+
+    def put(self, page_id: str, last_edited: str, body_text: str):
+        self.__remember(page_id, last_edited, body_text)
+
+        if self.__State is not None:
+            self.__State.save_body(page_id, last_edited, body_text)
+
+    def __remember(self, page_id: str, last_edited: str, body_text: str):
+        with self.__Lock:
+            self.__Bodies[page_id] = (last_edited, body_text)
+            self.__Bodies.move_to_end(page_id)
+
+            # drop the least recently used pages
+            while len(self.__Bodies) > self.__MAX_SIZE:
+                self.__Bodies.popitem(last=False)
@@ -0,0 +1,512 @@
+import email.parser
+import gzip
+import json
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+# stand-ins for the parts of the Notion and Google calendar apis the sync uses, so a sync cycle can be
+# measured locally at any size without touching the real services or their quotas
+class FakeApiServer:
+    def __init__(self, latency=0.0, rate_limit=None):
+        # seconds added to every response, and requests per second allowed before answering 429
+        self.__LATENCY = latency
+        self.__RATE_LIMIT = rate_limit
+
+        self.__Lock = threading.Lock()
+        self.__Window = 0
+        self.__WindowCount = 0
+
+        self.requests = Counter()
+        # response bytes as sent, after compression
+        self.bytes_sent = 0
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                server.handle(self, "GET")
+
+            def do_POST(self):
+                server.handle(self, "POST")
+
+            def do_PATCH(self):
+                server.handle(self, "PATCH")
+
+            def do_DELETE(self):
+                server.handle(self, "DELETE")
+
+            def log_message(self, *args):
+                pass
+
+        self.__Server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.__Server.daemon_threads = True
+        self.__Thread = threading.Thread(target=self.__Server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.__Server.server_address[1]}/"
+
+    def start(self):
+        self.__Thread.start()
+        return self
+
+    def stop(self):
+        self.__Server.shutdown()
+        self.__Server.server_close()
+
+    def handle(self, handler, method):
+        length = int(handler.headers.get("Content-Length", 0))
+        body = handler.rfile.read(length) if length else b""
+        parsed = urlparse(handler.path)
+
+        if self.__LATENCY:
+            time.sleep(self.__LATENCY)
+
+        if self.__is_rate_limited():
+            self.requests["rate_limited"] += 1
+            status, headers, content = self.rate_limited()
+        else:
+            status, headers, content = self.route(method, parsed.path, parse_qs(parsed.query), body,
+                                                  handler.headers)
+
+        if content and "gzip" in handler.headers.get("Accept-Encoding", ""):
+            content = gzip.compress(content)
+            headers = dict(headers, **{"Content-Encoding": "gzip"})
+
+        with self.__Lock:
+            self.bytes_sent += len(content)
+
+        handler.send_response(status)
+        for name, value in headers.items():
+            handler.send_header(name, value)
+        handler.send_header("Content-Length", str(len(content)))
+        handler.end_headers()
+        handler.wfile.write(content)
+
+    def __is_rate_limited(self) -> bool:
+        if self.__RATE_LIMIT is None:
+            return False
+
+        with self.__Lock:
+            window = int(time.monotonic())
+            if window != self.__Window:
+                self.__Window = window
+                self.__WindowCount = 0
+            self.__WindowCount += 1
+            return self.__WindowCount > self.__RATE_LIMIT
+
+    def route(self, method, path, query, body, headers):
+        raise NotImplementedError
+
+    def rate_limited(self):
+        raise NotImplementedError
+
+
+def json_response(status, data, headers=None):
+    all_headers = {"Content-Type": "application/json"}
+    all_headers.update(headers or {})
+    return status, all_headers, json.dumps(data).encode("utf-8")
+
+
+def notion_time(moment: datetime) -> str:
+    # Notion only keeps edit times to the minute
+    return moment.strftime("%Y-%m-%dT%H:%M:00.000Z")
+
+
+class FakeNotion(FakeApiServer):
+    def __init__(self, size=100, blocks_per_page=3, database_id="fake-database",
+                 title_header="Task", date_header="Due", message_id_header="Message_ID", **kwargs):
+        super().__init__(**kwargs)
+        self.database_id = database_id
+        self.__TitleHeader = title_header
+        self.__DateHeader = date_header
+        self.__Message_IDHeader = message_id_header
+
+        self.__Lock = threading.Lock()
+        self.pages = {}
+        self.__Order = []
+        self.__BlocksPerPage = blocks_per_page
+
+        today = datetime.utcnow()
+        for index in range(size):
+            page_id = str(uuid.uuid4())
+            self.pages[page_id] = {
+                "id": page_id,
+                "last_edited_time": notion_time(today),
+                "title": f"Task {index}",
+                "due": (today + timedelta(days=index % 365)).strftime("%Y-%m-%d"),
+                "msg_id": "",
+            }
+            self.__Order.append(page_id)
+
+    @property
+    def api_url(self) -> str:
+        return f"{self.url}v1"
+
+    # changes the title of 'count' random pages, like a user editing them between cycles
+    def edit_pages(self, count: int):
+        with self.__Lock:
+            for page_id in random.sample(self.__Order, min(count, len(self.__Order))):
+                page = self.pages[page_id]
+                page["title"] = page["title"] + "!"
+                page["last_edited_time"] = notion_time(datetime.utcnow())
+
+    def rate_limited(self):
+        return json_response(429, {"object": "error", "code": "rate_limited"}, {"Retry-After": "1"})
+
+    def route(self, method, path, query, body, headers):
+        parts = path.strip("/").split("/")[1:]
+
+        if parts[0] == "databases" and len(parts) == 2:
+            self.requests["notion_database"] += 1
+            return json_response(200, {"properties": self.__schema()})
+
+        if parts[0] == "databases" and parts[2] == "query":
+            self.requests["notion_query"] += 1
+            return self.__query(json.loads(body or b"{}"), query.get("filter_properties"))
+
+        if parts[0] == "pages" and method == "PATCH":
+            self.requests["notion_pages_patch"] += 1
+            return self.__patch_page(parts[1], json.loads(body))
+
+        if parts[0] == "blocks":
+            self.requests["notion_block_children"] += 1
+            return self.__children(parts[1], query)
+
+        return json_response(404, {"object": "error", "code": "object_not_found"})
+
+    def __schema(self):
+        return {self.__TitleHeader: {"id": "title", "type": "title"},
+                self.__DateHeader: {"id": "due", "type": "date"},
+                self.__Message_IDHeader: {"id": "msg", "type": "rich_text"}}
+
+    def __render(self, page, property_ids=None):
+        rendered = {
+            "object": "page",
+            "id": page["id"],
+            "last_edited_time": page["last_edited_time"],
+            "properties": {
+                self.__TitleHeader: {"id": "title", "type": "title",
+                                     "title": [{"text": {"content": page["title"]}, "plain_text": page["title"]}]},
+                self.__DateHeader: {"id": "due", "type": "date",
+                                    "date": {"start": page["due"], "end": None, "time_zone": None}},
+                self.__Message_IDHeader: {"id": "msg", "type": "rich_text",
+                                          "rich_text": [{"text": {"content": page["msg_id"]}}]
+                                          if page["msg_id"] else []},
+            }
+        }
+
+        if property_ids is not None:
+            rendered["properties"] = {name: value for name, value in rendered["properties"].items()
+                                      if value["id"] in property_ids}
+        return rendered
+
+    def __matches(self, page, rule) -> bool:
+        if "and" in rule:
+            return all(self.__matches(page, part) for part in rule["and"])
+        if "or" in rule:
+            return any(self.__matches(page, part) for part in rule["or"])
+
+        if rule.get("timestamp") == "last_edited_time":
+            condition = rule["last_edited_time"]
+            value = page["last_edited_time"]
+        elif rule.get("property") == self.__DateHeader:
+            condition = rule["date"]
+            value = page["due"]
+        elif rule.get("property") == self.__Message_IDHeader:
+            condition = rule["rich_text"]
+            value = page["msg_id"]
+        else:
+            return True
+
+        for operator, operand in condition.items():
+            if operator == "is_not_empty" and not value:
+                return False
+            if operator == "is_empty" and value:
+                return False
+            if operator == "equals" and value != operand:
+                return False
+            if operator == "on_or_after" and (not value or value[:len(operand)] < operand[:len(value)]):
+                return False
+            if operator == "on_or_before" and (not value or value[:len(operand)] > operand[:len(value)]):
+                return False
+            if operator == "after" and (not value or value <= operand):
+                return False
+            if operator == "before" and (not value or value >= operand):
+                return False
+        return True
+
+    def __query(self, rule, property_ids=None):
+        with self.__Lock:
+            matching = [self.pages[page_id] for page_id in self.__Order
+                        if self.__matches(self.pages[page_id], rule.get("filter", {}))]
+
+        for sort in rule.get("sorts", []):
+            if sort.get("timestamp") == "last_edited_time":
+                matching.sort(key=lambda page: page["last_edited_time"], reverse=sort["direction"] == "descending")
+
+        start = int(rule.get("start_cursor") or 0)
+        size = min(int(rule.get("page_size", 100)), 100)
+        chunk = matching[start:start + size]
+        has_more = start + size < len(matching)
+
+        return json_response(200, {"object": "list",
+                                   "results": [self.__render(page, property_ids) for page in chunk],
+                                   "has_more": has_more,
+                                   "next_cursor": str(start + size) if has_more else None})
+
+    def __patch_page(self, page_id, data):
+        with self.__Lock:
+            page = self.pages.get(page_id)
+            if page is None:
+                return json_response(404, {"object": "error", "code": "object_not_found"})
+
+            properties = data.get("properties", {})
+            if self.__Message_IDHeader in properties:
+                rich_text = properties[self.__Message_IDHeader]["rich_text"]
+                page["msg_id"] = rich_text[0]["text"]["content"] if rich_text else ""
+            if self.__TitleHeader in properties:
+                page["title"] = properties[self.__TitleHeader]["title"][0]["text"]["content"]
+            if self.__DateHeader in properties:
+                page["due"] = (properties[self.__DateHeader]["date"] or {}).get("start")
+            page["last_edited_time"] = notion_time(datetime.utcnow())
+
+            return json_response(200, self.__render(page))
+
+    def __children(self, page_id, query):
+        if page_id not in self.pages:
+            return json_response(404, {"object": "error", "code": "object_not_found"})
+
+        start = int(query.get("start_cursor", ["0"])[0])
+        size = min(int(query.get("page_size", ["100"])[0]), 100)
+        end = min(start + size, self.__BlocksPerPage)
+        blocks = [{"type": "paragraph",
+                   "paragraph": {"rich_text": [{"text": {"content": f"Line {index} of {page_id}"}}]}}
+                  for index in range(start, end)]
+        has_more = end < self.__BlocksPerPage
+
+        return json_response(200, {"object": "list",
+                                   "results": blocks,
+                                   "has_more": has_more,
+                                   "next_cursor": str(end) if has_more else None})
+
+
+class FakeGoogleCalendar(FakeApiServer):
+    def __init__(self, calendar_name="notion", **kwargs):
+        super().__init__(**kwargs)
+        self.calendar = {"id": "fake-calendar", "summary": calendar_name}
+
+        self.__Lock = threading.Lock()
+        self.events = {}
+        self.__Sequence = 0
+
+    # changes an event like a user editing it in the calendar
+    def edit_event(self, event_id: str, **changes):
+        with self.__Lock:
+            event = self.events[event_id]
+            event.update(changes)
+            self.__touch(event)
+
+    def rate_limited(self):
+        return json_response(403, {"error": {"code": 403, "message": "Rate Limit Exceeded",
+                                             "errors": [{"reason": "rateLimitExceeded"}]}})
+
+    def route(self, method, path, query, body, headers):
+        if path.startswith("/batch/"):
+            self.requests["google_batch"] += 1
+            return self.__batch(body, headers)
+        return self.__call(method, path, query, body)
+
+    # answers like Google, only with the 'fields' that were asked for
+    def __call(self, method, path, query, body):
+        status, headers, content = self.__dispatch(method, path, query, body)
+        if status != 200 or "fields" not in query:
+            return status, headers, content
+        return json_response(status, select_fields(json.loads(content), query["fields"][0]))
+
+    def __dispatch(self, method, path, query, body):
+        parts = path.strip("/").split("/")[2:]
+
+        if parts[:3] == ["users", "me", "calendarList"]:
+            self.requests["google_calendar_list"] += 1
+            return json_response(200, {"items": [self.calendar]})
+
+        if parts == ["calendars"] and method == "POST":
+            self.requests["google_calendar_insert"] += 1
+            self.calendar = dict(json.loads(body), id="fake-calendar")
+            return json_response(200, self.calendar)
+
+        if len(parts) >= 3 and parts[2] == "events":
+            if parts[1] != self.calendar["id"]:
+                return self.__not_found()
+
+            event_id = parts[3] if len(parts) > 3 else None
+
+            if method == "GET" and event_id is None:
+                self.requests["google_events_list"] += 1
+                return self.__list(query)
+            if method == "GET":
+                self.requests["google_events_get"] += 1
+                return self.__get(event_id)
+            if method == "POST":
+                self.requests["google_events_insert"] += 1
+                return self.__insert(json.loads(body))
+            if method == "PATCH":
+                self.requests["google_events_patch"] += 1
+                return self.__patch(event_id, json.loads(body))
+            if method == "DELETE":
+                self.requests["google_events_delete"] += 1
+                return self.__delete(event_id)
+
+        return self.__not_found()
+
+    def __not_found(self):
+        return json_response(404, {"error": {"code": 404, "message": "Not Found"}})
+
+    def __touch(self, event):
+        self.__Sequence += 1
+        event["sequence_number"] = self.__Sequence
+        event["updated"] = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+    def __public(self, event):
+        return {key: value for key, value in event.items() if key != "sequence_number"}
+
+    def __list(self, query):
+        sync_token = query.get("syncToken", [None])[0]
+        with self.__Lock:
+            if sync_token is not None:
+                if int(sync_token) > self.__Sequence:
+                    return json_response(410, {"error": {"code": 410, "message": "Sync token is no longer valid"}})
+                events = [event for event in self.events.values() if event["sequence_number"] > int(sync_token)]
+            else:
+                events = [event for event in self.events.values() if event["status"] != "cancelled"]
+            next_sync_token = str(self.__Sequence)
+
+        start = int(query.get("pageToken", ["0"])[0])
+        size = int(query.get("maxResults", ["250"])[0])
+        chunk = events[start:start + size]
+
+        data = {"items": [self.__public(event) for event in chunk]}
+        if start + size < len(events):
+            data["nextPageToken"] = str(start + size)
+        else:
+            data["nextSyncToken"] = next_sync_token
+        return json_response(200, data)
+
+    def __get(self, event_id):
+        with self.__Lock:
+            event = self.events.get(event_id)
+            if event is None:
+                return self.__not_found()
+            return json_response(200, self.__public(event))
+
+    def __insert(self, data):
+        with self.__Lock:
+            event_id = data.get("id") or uuid.uuid4().hex
+            if event_id in self.events:
+                return json_response(409, {"error": {"code": 409, "message": "The requested identifier already exists."}})
+
+            event = dict(data, id=event_id, status="confirmed")
+            self.__touch(event)
+            self.events[event_id] = event
+            return json_response(200, self.__public(event))
+
+    def __patch(self, event_id, data):
+        with self.__Lock:
+            event = self.events.get(event_id)
+            if event is None or event["status"] == "cancelled":
+                return self.__not_found()
+
+            event.update(data)
+            self.__touch(event)
+            return json_response(200, self.__public(event))
+
+    def __delete(self, event_id):
+        with self.__Lock:
+            event = self.events.get(event_id)
+            if event is None or event["status"] == "cancelled":
+                return json_response(410, {"error": {"code": 410, "message": "Resource has been deleted"}})
+
+            event["status"] = "cancelled"
+            self.__touch(event)
+            return 204, {}, b""
+
+    # answers a multipart/mixed batch, every part is handled like a separate request
+    def __batch(self, body, headers):
+        message = email.parser.BytesParser().parsebytes(
+            f"Content-Type: {headers['Content-Type']}\r\n\r\n".encode("utf-8") + body)
+
+        boundary = uuid.uuid4().hex
+        parts = []
+        for part in message.get_payload():
+            request = part.get_payload(decode=False)
+            head, _, request_body = request.partition("\r\n\r\n")
+            if not _:
+                head, _, request_body = request.partition("\n\n")
+            request_line = head.splitlines()[0]
+            method, uri, _version = request_line.split(" ")
+            parsed = urlparse(uri)
+
+            status, response_headers, content = self.__call(method, parsed.path, parse_qs(parsed.query),
+                                                            request_body.encode("utf-8"))
+
+            content_id = part["Content-ID"][1:-1]
+            parts.append(f"--{boundary}\r\n"
+                         f"Content-Type: application/http\r\n"
+                         f"Content-ID: <response-{content_id}>\r\n\r\n"
+                         f"HTTP/1.1 {status} OK\r\n"
+                         f"Content-Type: application/json\r\n"
+                         f"Content-Length: {len(content)}\r\n\r\n"
+                         f"{content.decode('utf-8')}\r\n")
+
+        content = ("".join(parts) + f"--{boundary}--\r\n").encode("utf-8")
+        return 200, {"Content-Type": f"multipart/mixed; boundary={boundary}"}, content
+
+
+# applies a Google partial response selector like "items(id,status,end),nextPageToken" to 'data'
+def select_fields(data, fields: str):
+    if isinstance(data, list):
+        return [select_fields(item, fields) for item in data]
+    if not isinstance(data, dict):
+        return data
+
+    selected = {}
+    for field in split_fields(fields):
+        name, _, nested = field.partition("(")
+        path = name.split("/")
+        if path[0] not in data:
+            continue
+
+        if len(path) > 1:
+            value = select_fields(data[path[0]], "/".join(path[1:]) + (f"({nested}" if nested else ""))
+        elif nested:
+            value = select_fields(data[path[0]], nested[:-1])
+        else:
+            value = data[path[0]]
+        selected[path[0]] = value
+    return selected
+
+
+# splits on the commas that are not inside brackets
+def split_fields(fields: str) -> list:
+    parts = []
+    depth = 0
+    current = ""
+    for character in fields:
+        if character == "," and depth == 0:
+            parts.append(current)
+            current = ""
+            continue
+        depth += {"(": 1, ")": -1}.get(character, 0)
+        current += character
+    parts.append(current)
+    return [part.strip() for part in parts if part.strip()]
@@ -1,12 +1,11 @@
-import os
-import pickle
-import time
+import json
+import random
+import threading
 
-import google.auth.transport.requests
-from apiclient import discovery
-from google_auth_oauthlib.flow import InstalledAppFlow
 from datetime import datetime, timedelta
 
+from metrics import metrics
+from rate_limit import RequestScheduler
 from utilities import create_log
 
 from googleapiclient import errors
@@ -18,115 +17,196 @@ class Google:
                  token_location='creds/token.pickle',
                  calender_name="notion",
                  calender_reminder=False,
-                 calender_reminder_time=15):
+                 calender_reminder_time=15,
+                 scheduler=None,
+                 credentials=None,
+                 api_root=None,
+                 warm_cache=None,
+                 read_only=False):
         self.__SCOPES = ['https://www.googleapis.com/auth/calendar']
         self.__CRED_LOCATION = cred_location
         self.__TOKEN_LOCATION = token_location
         self.__CALENDER_NAME = calender_name
         self.__CALENDER_ID = None
 
+        # a dry run reports a missing calendar instead of creating it
+        self.__READ_ONLY = read_only
+
         self.__CALENDER_REMINDER = calender_reminder
         self.__CALENDER_REMINDER_TIME = calender_reminder_time
+        self.__Scheduler = scheduler if scheduler is not None else RequestScheduler()
+        # the service sends everything over one httplib2 connection, which is not thread safe
+        self.__ServiceLock = threading.Lock()
+
+        # Google allows at most 50 calls in a batch request
+        self.__BATCH_LIMIT = 50
+        self.__BATCH_RETRIES = 5
+
+        # SyncState keeping the discovery document and calendar id between starts, None looks them up every time
+        self.__WarmCache = warm_cache
+        self.__CalendarCached = False
+        self.__DISCOVERY_URL = "https://www.googleapis.com/discovery/v1/apis/calendar/v3/rest"
+
+        # another server speaking the calendar api, e.g. the stand-in used by benchmark.py
+        self.__API_ROOT = api_root
+        self.__BATCH_URI = f"{api_root or 'https://www.googleapis.com/'}batch/calendar/v3"
+
+        # the token is refreshed in the background, so the one service below lives as long as the process
+        self.__CredentialManager = None
+        if credentials is not None:
+            self.__Creds = credentials
+        else:
+            from google_credentials import CredentialManager
+            self.__CredentialManager = CredentialManager(cred_location=self.__CRED_LOCATION,
+                                                         token_location=self.__TOKEN_LOCATION,
+                                                         scopes=self.__SCOPES)
+            self.__CredentialManager.start()
+            self.__Creds = self.__CredentialManager.credentials
 
-        # check if credentials.json is present
-        self.__check_for_creds()
-
-        self.__Google_Refresh = google.auth.transport.requests.Request()
-        self.__Google_Flow = InstalledAppFlow.from_client_secrets_file(self.__CRED_LOCATION, self.__SCOPES)
-
-        self.__Creds = self.__get_credentials()
-        self.__Google_Service = discovery.build('calendar', 'v3', credentials=self.__Creds, static_discovery=False)
+        self.__Google_Service = self.__build_service()
 
         # Checks if the calendar is present, if not it will be created
         self.__check_calendar()
 
-    # check if the credentials.json exists
-    def __check_for_creds(self):
-        if not os.path.exists(self.__CRED_LOCATION):
-            create_log(f"'{self.__CRED_LOCATION}' is missing!", "red")
-            exit(-1)
-        else:
-            create_log("Google credentials present.", "green")
-
-    # gets the token to access the Google api
-    def __get_credentials(self):
-        creds = None
-
-        # get the credentials
-        if os.path.exists(self.__TOKEN_LOCATION):
-            create_log("Token present, loading...", "green")
-            with open(self.__TOKEN_LOCATION, 'rb') as token:
-                creds = pickle.load(token)
-
-        # check if there is need to get or  refresh the token
-        if not creds or not creds.valid:
-            # check if it can refresh the creds automatically
-            if creds and creds.expired and creds.refresh_token:
-                create_log("Refreshing token automatically.", "green")
-                try:
-                    creds.refresh(self.__Google_Refresh)
-                except google.auth.exceptions.RefreshError:
-
-                    create_log("Auto refresh failed, manual refresh needed.", "red")
-                    creds = self.__Google_Flow.run_console()
-            else:
-                # create a flow to login user
-                create_log("Auto refresh failed, manual refresh needed.", "yellow")
-                creds = self.__Google_Flow.run_console()
-
-            # saves the credentials
-            with open(self.__TOKEN_LOCATION, 'wb') as token:
-                pickle.dump(creds, token)
-
-        if creds.valid:
-            create_log("Token loaded successfully.", "green")
-            return creds
-        else:
-            create_log("Failed to load the credentials!", "red")
+    # every request of the service goes through here, so the threads sharing this object take turns sending them
+    def __execute(self, request, tokens=1):
+        with self.__ServiceLock:
+            return self.__Scheduler.execute("google", request, tokens=tokens)
+
+    # the client is imported here, so importing this module for its helpers stays cheap, see --once in main.py
+    def __build_service(self):
+        from apiclient import discovery
+
+        if self.__API_ROOT is None:
+            return discovery.build_from_document(self.__get_discovery_document(), credentials=self.__Creds)
+
+        # the bundled discovery document is used, as the other server does not serve one
+        return discovery.build('calendar', 'v3',
+                               credentials=self.__Creds,
+                               static_discovery=True,
+                               client_options={"api_endpoint": f"{self.__API_ROOT}calendar/v3/"})
+
+    # the calendar api description, downloaded once and then served from the warm cache
+    def __get_discovery_document(self, use_cache=True):
+        if use_cache and self.__WarmCache is not None:
+            document = self.__WarmCache.get_value("google_discovery_document")
+            if document is not None:
+                if is_discovery_document(document):
+                    return document
+                create_log("Cached google discovery document is invalid, downloading it again", "yellow")
+
+        response = self.__Scheduler.send("google", "get", self.__DISCOVERY_URL, endpoint="discovery")
+        response.raise_for_status()
+        if not is_discovery_document(response.text):
+            create_log("Google did not send a valid discovery document!", "red")
             exit(-1)
 
-    # get the info about one event
-    def get_event(self, event_id):
-        if self.__Creds.expired:
-            self.__Creds = self.__get_credentials()
-            self.__Google_Service = discovery.build('calendar', 'v3', credentials=self.__Creds, static_discovery=False)
+        if self.__WarmCache is not None:
+            self.__WarmCache.set_value("google_discovery_document", response.text)
+        return response.text
 
-        event = self.__Google_Service.events().get(calendarId=self.__CALENDER_ID, eventId=event_id).execute()
+    # get the info about one event, 'fields' limits it to the given fields
+    def get_event(self, event_id, fields=None):
+        params = {"fields": fields} if fields is not None else {}
+        event = self.__execute(self.__Google_Service.events().get(calendarId=self.__CALENDER_ID,
+                                                                  eventId=event_id,
+                                                                  **params))
         return event
 
     # returns all the events from the Google calendar
     def get_events(self):
-        if self.__Creds.expired:
-            self.__Creds = self.__get_credentials()
-            self.__Google_Service = discovery.build('calendar', 'v3', credentials=self.__Creds, static_discovery=False)
-
         now = datetime.utcnow().isoformat() + 'Z'
-        events_result = self.__Google_Service.events().list(
-            calendarId=self.__CALENDER_ID,
-            timeMin=now,
-            maxResults=20,
-            singleEvents=True,
-            orderBy='startTime').execute()
-
-        events = events_result.get('items', [])
-        return events
+        events = []
+        page_token = None
+        while True:
+            events_result = self.__list_events(timeMin=now,
+                                               maxResults=250,
+                                               singleEvents=True,
+                                               orderBy='startTime',
+                                               pageToken=page_token,
+                                               fields="items(id),nextPageToken")
+
+            events.extend(events_result.get('items', []))
+            page_token = events_result.get('nextPageToken')
+            if not page_token:
+                return events
+
+    # returns the events changed since 'sync_token', the token for the next call and if it was a full sync,
+    # without a token (or if it expired) every event in the calendar is returned,
+    # 'details' also asks for the title, description, dates and updated time of each event
+    def get_changed_events(self, sync_token=None, details=False):
+        fields = "items(id,status,end),nextPageToken,nextSyncToken"
+        if details:
+            fields = "items(id,status,summary,description,start,end,updated),nextPageToken,nextSyncToken"
+
+        events = []
+        page_token = None
+        while True:
+            try:
+                # the id, whether it was cancelled and its end is all the state keeps of an event
+                events_result = self.__list_events(maxResults=250,
+                                                   singleEvents=True,
+                                                   syncToken=sync_token,
+                                                   pageToken=page_token,
+                                                   fields=fields)
+            except errors.HttpError as e:
+                # the token expired or was invalidated, the only way back is a full sync
+                if e.status_code == 410 and sync_token is not None:
+                    create_log("Google sync token expired, doing a full sync of the calendar", "yellow")
+                    return self.get_changed_events(details=details)
+                raise
+
+            events.extend(events_result.get('items', []))
+            page_token = events_result.get('nextPageToken')
+            if not page_token:
+                return events, events_result.get('nextSyncToken'), sync_token is None
+
+    # lists the events of the calendar, a cached calendar id that stopped working is looked up again once
+    def __list_events(self, **kwargs):
+        # the calendar a dry run did not create has no events
+        if self.__CALENDER_ID is None:
+            return {}
+
+        try:
+            return self.__execute(self.__Google_Service.events().list(calendarId=self.__CALENDER_ID, **kwargs))
+        except errors.HttpError as e:
+            if e.status_code != 404 or not self.__CalendarCached:
+                raise
+
+            create_log(f"Cached id of '{self.__CALENDER_NAME}' is no longer valid, looking it up again", "yellow")
+            self.__check_calendar(use_cache=False)
+            return self.__list_events(**kwargs)
 
     # Used to validate the calendar
-    def __check_calendar(self):
-        if self.__Creds.expired:
-            self.__Creds = self.__get_credentials()
-            self.__Google_Service = discovery.build('calendar', 'v3', credentials=self.__Creds, static_discovery=False)
+    def __check_calendar(self, use_cache=True):
+        # the id found last time is trusted until a request using it fails
+        cache_key = f"google_calendar_id:{self.__CALENDER_NAME}"
+        self.__CalendarCached = False
+        if use_cache and self.__WarmCache is not None:
+            calendar_id = self.__WarmCache.get_value(cache_key)
+            if calendar_id is not None:
+                self.__CALENDER_ID = calendar_id
+                self.__CalendarCached = True
+                create_log(f"{self.__CALENDER_NAME} present (cached)", "green")
+                return
 
         page_token = None
         while True:
-            calendar_list = self.__Google_Service.calendarList().list(pageToken=page_token).execute()
+            calendar_list = self.__execute(self.__Google_Service.calendarList().list(pageToken=page_token,
+                                                                                     fields="items(id,summary)"))
             for calendar_list_entry in calendar_list['items']:
                 if calendar_list_entry["summary"] == self.__CALENDER_NAME:
                     # found a calendar we need
                     self.__CALENDER_ID = calendar_list_entry["id"]
                     create_log(f"{self.__CALENDER_NAME} present", "green")
+                    if self.__WarmCache is not None:
+                        self.__WarmCache.set_value(cache_key, self.__CALENDER_ID)
                     return
 
+            if self.__READ_ONLY:
+                create_log(f"Dry run: would create calender '{self.__CALENDER_NAME}'", "yellow")
+                return
+
             # Need to create a calendar
             create_log(f"Calender not present, going to create calender '{self.__CALENDER_NAME}'", "yellow")
 
@@ -134,26 +214,86 @@ class Google:
                 'summary': self.__CALENDER_NAME,
             }
 
-            created_calendar = self.__Google_Service.calendars().insert(body=calendar).execute()
+            created_calendar = self.__execute(self.__Google_Service.calendars().insert(body=calendar))
 
             create_log(f"Created a calender called {self.__CALENDER_NAME}.", "green")
             self.__CALENDER_ID = created_calendar["id"]
 
-    # used to delete the event from the calendar
-    def delete_event(self, event_id):
-        if self.__Creds.expired:
-            self.__Creds = self.__get_credentials()
-            self.__Google_Service = discovery.build('calendar', 'v3', credentials=self.__Creds, static_discovery=False)
-
-        event = self.__Google_Service.events().delete(calendarId=self.__CALENDER_ID, eventId=event_id).execute()
-        return event
-
-    def patch_event(self, summary, description, start_time, end_time, event_id):
-        if self.__Creds.expired:
-            self.__Creds = self.__get_credentials()
-            self.__Google_Service = discovery.build('calendar', 'v3', credentials=self.__Creds, static_discovery=False)
-
+    # sends the writes as multipart batch requests, each operation is a dict with an "id" used to route the
+    # result back, a "method" (insert, patch or delete) and the "event" body and/or "event_id" it needs
+    def batch_write(self, operations: list):
+        results = {}
+        failures = {}
+
+        pending = list(operations)
+        attempt = 0
+        while pending:
+            retry = []
+            existing = []
+            for start in range(0, len(pending), self.__BATCH_LIMIT):
+                chunk = pending[start:start + self.__BATCH_LIMIT]
+                responses = self.__execute_batch(chunk)
+
+                for index, operation in enumerate(chunk):
+                    response, exception = responses[str(index)]
+                    metrics.inc("sync_batch_calls_total",
+                                {"method": operation["method"],
+                                 "status": "200" if exception is None else str(exception.status_code)},
+                                help_text="Calls sent to google calendar inside batch requests")
+                    if exception is None:
+                        results[operation["id"]] = response
+                    elif operation["method"] == "delete" and exception.status_code in (404, 410):
+                        # already gone, which is all a delete wants
+                        results[operation["id"]] = None
+                    elif operation["method"] == "insert" and exception.status_code == 409 \
+                            and "id" in operation["event"]:
+                        # an earlier attempt with this id reached Google, it is brought up to date instead
+                        existing.append(dict(operation, method="patch", event_id=operation["event"]["id"]))
+                    elif self.__Scheduler.is_retryable(exception) and attempt < self.__BATCH_RETRIES:
+                        retry.append(operation)
+                    else:
+                        failures[operation["id"]] = exception
+
+            # only the operations that failed are sent again
+            if retry:
+                create_log(f"{len(retry)} google calendar writes failed, sending them again", "yellow",
+                           key="batch_retry")
+                self.__Scheduler.backoff("google", attempt)
+                attempt += 1
+            pending = retry + existing
+
+        return results, failures
+
+    def __execute_batch(self, operations: list) -> dict:
+        responses = {}
+
+        def callback(request_id, response, exception):
+            responses[request_id] = (response, exception)
+
+        from googleapiclient.http import BatchHttpRequest
+
+        batch = BatchHttpRequest(callback=callback, batch_uri=self.__BATCH_URI)
+        for index, operation in enumerate(operations):
+            batch.add(self.__write_request(operation), request_id=str(index))
+        self.__execute(batch, tokens=len(operations))
+
+        return responses
+
+    def __write_request(self, operation):
+        events = self.__Google_Service.events()
+
+        # Google sends the whole event back unless asked not to, the sync only reads these
+        if operation["method"] == "insert":
+            return events.insert(calendarId=self.__CALENDER_ID, body=operation["event"], fields="id,summary,updated")
+        if operation["method"] == "patch":
+            return events.patch(calendarId=self.__CALENDER_ID, eventId=operation["event_id"], body=operation["event"],
+                                fields="id,updated")
+        return events.delete(calendarId=self.__CALENDER_ID, eventId=operation["event_id"])
+
+    # creates the event body, returns -1 if the start and end are not the same kind of date
+    def build_event(self, summary, description, start_time, end_time):
         if len(start_time) == 10 and len(end_time) == 10:
+            # the end of a whole day event is exclusive in Google, get_notion_dates takes the day off again
             date = datetime.strptime(end_time, "%Y-%m-%d")
             modified_date = date + timedelta(days=1)
             end_time = datetime.strftime(modified_date, "%Y-%m-%d")
@@ -163,53 +303,7 @@ class Google:
         else:
             return -1
 
-        event = self.__crete_event(summary=summary,
-                                   description=description,
-                                   start_time=start_time,
-                                   end_time=end_time,
-                                   date_type=date_type)
-
-        run = True
-        while run:
-            try:
-                event = self.__Google_Service.events().patch(calendarId=self.__CALENDER_ID,
-                                                             eventId=event_id,
-                                                             body=event).execute()
-                run = False
-            except errors.HttpError as e:
-                if e.status_code == 403:
-                    create_log("Too many requests to google calendar, waiting 10 seconds", "yellow")
-                    time.sleep(10)
-                # if e.status_code == 404:
-                #     create_log("Error when trying to patch event, probably deleted, creating new event", "yellow")
-                #     event = self.__Google_Service.events().insert(calendarId=self.__CALENDER_ID, body=event).execute()
-                #     create_log(f"Created event {event['summary']}", "green")
-
-                else:
-                    create_log(f"There was an error when sending the patch request to google calendar, trying again "
-                               f"in 10 seconds '{e.status_code}', reason {e.reason}", "red")
-                    time.sleep(10)
-
-        return event
-
-    def create_event(self, summary, description, start_time, end_time):
-        if self.__Creds.expired:
-            self.__Creds = self.__get_credentials()
-            self.__Google_Service = discovery.build('calendar', 'v3', credentials=self.__Creds, static_discovery=False)
-
-        if len(start_time) == 10 and len(end_time) == 10:
-            date_type = "date"
-        elif len(start_time) == 29 and len(end_time) == 29:
-            date_type = "dateTime"
-        else:
-            return -1
-
-        event = self.__crete_event(summary, description, start_time, end_time, date_type)
-
-        event = self.__Google_Service.events().insert(calendarId=self.__CALENDER_ID, body=event).execute()
-
-        create_log(f"Created event {event['summary']}", "green")
-        return event.get("id")
+        return self.__crete_event(summary, description, start_time, end_time, date_type)
 
     def __crete_event(self, summary, description, start_time, end_time, date_type):
         event = {
@@ -233,4 +327,39 @@ class Google:
                                          {'method': 'popup', 'minutes': self.__CALENDER_REMINDER_TIME},
                                      ],
                                  }
+        else:
+            # set on patches too, so turning GoogleReminder off removes the reminder of the existing events
+            event["reminders"] = {'useDefault': True}
         return event
+
+
+def is_discovery_document(document: str) -> bool:
+    try:
+        description = json.loads(document)
+    except ValueError:
+        return False
+    return isinstance(description, dict) and "rootUrl" in description and "resources" in description
+
+
+# a new id for the event of the page, chosen before the insert is sent so a retried insert can not create it twice,
+# Google event ids may only use the base32hex characters, which the hex of the page id already does
+def create_event_id(page_id: str) -> str:
+    suffix = "".join(random.choice("0123456789abcdefghijklmnopqrstuv") for _ in range(6))
+    return page_id.replace("-", "").lower() + suffix
+
+
+# the start and end of a Google event the way Notion stores them, the inverse of Google.build_event,
+# the end is None when the event ends when it starts
+def get_notion_dates(event):
+    start = event["start"].get("dateTime", event["start"].get("date"))
+    end = event["end"].get("dateTime", event["end"].get("date"))
+
+    # the end of a whole day event is exclusive in Google
+    if "date" in event["end"]:
+        end = (datetime.strptime(end, "%Y-%m-%d") - timedelta(days=1)).strftime("%Y-%m-%d")
+        if end <= start:
+            end = None
+    elif end == start:
+        end = None
+
+    return start, end
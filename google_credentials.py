@@ -0,0 +1,130 @@
+import os
+import pickle
+import tempfile
+import threading
+from datetime import datetime
+
+import google.auth.exceptions
+import google.auth.transport.requests
+from google_auth_oauthlib.flow import InstalledAppFlow
+
+from utilities import create_log
+
+
+class CredentialManager:
+    def __init__(self,
+                 cred_location='creds/credentials.json',
+                 token_location='creds/token.pickle',
+                 scopes=('https://www.googleapis.com/auth/calendar',),
+                 refresh_margin=300):
+        self.__CRED_LOCATION = cred_location
+        self.__TOKEN_LOCATION = token_location
+        self.__SCOPES = list(scopes)
+        # seconds before the token expires that it is refreshed in the background
+        self.__REFRESH_MARGIN = refresh_margin
+
+        self.__Lock = threading.Lock()
+        self.__Timer = None
+
+        # check if credentials.json is present
+        self.__check_for_creds()
+
+        self.__Google_Refresh = google.auth.transport.requests.Request()
+        self.__Google_Flow = InstalledAppFlow.from_client_secrets_file(self.__CRED_LOCATION, self.__SCOPES)
+
+        self.credentials = self.__get_credentials()
+
+    # check if the credentials.json exists
+    def __check_for_creds(self):
+        if not os.path.exists(self.__CRED_LOCATION):
+            create_log(f"'{self.__CRED_LOCATION}' is missing!", "red")
+            exit(-1)
+        else:
+            create_log("Google credentials present.", "green")
+
+    # gets the token to access the Google api
+    def __get_credentials(self):
+        creds = None
+
+        # get the credentials
+        if os.path.exists(self.__TOKEN_LOCATION):
+            create_log("Token present, loading...", "green")
+            with open(self.__TOKEN_LOCATION, 'rb') as token:
+                creds = pickle.load(token)
+
+        # check if there is need to get or  refresh the token
+        if not creds or not creds.valid:
+            # check if it can refresh the creds automatically
+            if creds and creds.expired and creds.refresh_token:
+                create_log("Refreshing token automatically.", "green")
+                try:
+                    creds.refresh(self.__Google_Refresh)
+                except google.auth.exceptions.RefreshError:
+
+                    create_log("Auto refresh failed, manual refresh needed.", "red")
+                    creds = self.__Google_Flow.run_console()
+            else:
+                # create a flow to login user
+                create_log("Auto refresh failed, manual refresh needed.", "yellow")
+                creds = self.__Google_Flow.run_console()
+
+            self.__save_credentials(creds)
+
+        if creds.valid:
+            create_log("Token loaded successfully.", "green")
+            return creds
+        else:
+            create_log("Failed to load the credentials!", "red")
+            exit(-1)
+
+    # writes to a temporary file first, so a crash never leaves a half written token behind
+    def __save_credentials(self, creds):
+        folder = os.path.dirname(os.path.abspath(self.__TOKEN_LOCATION))
+        handle, temporary_location = tempfile.mkstemp(dir=folder, suffix=".tmp")
+        try:
+            with os.fdopen(handle, 'wb') as token:
+                pickle.dump(creds, token)
+            os.replace(temporary_location, self.__TOKEN_LOCATION)
+        except BaseException:
+            os.remove(temporary_location)
+            raise
+
+    # keeps refreshing the token ahead of its expiry on a background timer
+    def start(self, retry_in=None):
+        with self.__Lock:
+            if self.__Timer is not None:
+                self.__Timer.cancel()
+
+            expiry = self.credentials.expiry
+            if expiry is None or not self.credentials.refresh_token:
+                return
+
+            delay = retry_in
+            if delay is None:
+                delay = max(0, (expiry - datetime.utcnow()).total_seconds() - self.__REFRESH_MARGIN)
+            self.__Timer = threading.Timer(delay, self.__refresh)
+            self.__Timer.daemon = True
+            self.__Timer.start()
+
+    def stop(self):
+        with self.__Lock:
+            if self.__Timer is not None:
+                self.__Timer.cancel()
+                self.__Timer = None
+
+    def __refresh(self):
+        try:
+            # refreshed in place, so the service built with these credentials picks the new token up
+            self.credentials.refresh(self.__Google_Refresh)
+            self.__save_credentials(self.credentials)
+            create_log("Refreshed the Google token in the background.", "green")
+        except google.auth.exceptions.RefreshError as error:
+            # the token was revoked, only a manual login can fix that
+            create_log(f"Background refresh of the Google token failed, reason {error}", "red")
+            return
+        except (google.auth.exceptions.TransportError, OSError) as error:
+            create_log(f"Could not reach Google to refresh the token, reason {error}", "yellow")
+            self.start(retry_in=30)
+            return
+
+        self.start()
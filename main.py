@@ -1,22 +1,58 @@
+import argparse
+import logging
+import threading
 import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from functools import partial
+from itertools import islice
 from time import sleep
 
 import requests
 from decouple import config
+from googleapiclient import errors
 
-from google_calender import Google
-from notion import Notion
-from termcolor import colored
+from google_calender import Google, create_event_id, get_notion_dates
+from body_cache import BodyCache
+from metrics import metrics
+from notion import Notion, NotionError
+from planner import SyncPlan, create_plan, find_unlinked_events, plan_deletes
+from poller import AdaptivePoller
+from rate_limit import RequestScheduler
+from sync_pairs import load_sync_pairs
+from sync_state import SyncState, create_fingerprint, parse_time, unchanged_since
 
 import os
 
-from utilities import create_log
+from utilities import create_log, setup_logging
+from worker import Worker
 
 
-def main():
+# pages planned and written together, one page of notion results
+PAGES_PER_CHUNK = 100
+
+# returns the exit status, None when it finished
+def main(dry_run=False, worker=False, backfill_from=None, backfill_until=None, backfill_window_days=30,
+         backfill_parallel=4, once=False):
     # check if the env file exists
     check_for_env_file()
 
+    log_format = config("LogFormat", default="text")
+    log_level = config("LogLevel", default="INFO").upper()
+    if log_format not in ("text", "json") or log_level not in ("DEBUG", "INFO", "WARNING", "ERROR"):
+        create_log("LogFormat can be text or json, LogLevel DEBUG, INFO, WARNING or ERROR", "red")
+        exit()
+
+    log_repeat_interval = None
+    try:
+        log_repeat_interval = config("LogRepeatInterval", default=60, cast=float)
+    except ValueError:
+        create_log("Value of LogRepeatInterval must be a number", "red")
+        exit()
+
+    setup_logging(log_format=log_format, level=log_level, repeat_interval=log_repeat_interval)
+
     # get the vars from .env file
     user_secret = config('ClientSecret', default=-1)
     database_id = config('DatabaseId', default=-1)
@@ -30,7 +66,44 @@ def main():
         create_log("Value of Frequency must be a number", "red")
         exit()
 
+    max_sleep_freq = None
+    poll_jitter = None
+    try:
+        max_sleep_freq = config("MaxFrequency", default=sleep_freq * 10, cast=int)
+        poll_jitter = config("FrequencyJitter", default=0.1, cast=float)
+    except ValueError:
+        create_log("Values of MaxFrequency and FrequencyJitter must be numbers", "red")
+        exit()
+
     calendar_name = config("CalendarName", default="notion")
+    state_file = config("StateFile", default="sync_state.db")
+
+    incremental_sync = None
+    try:
+        incremental_sync = config("IncrementalSync", default=True, cast=bool)
+    except ValueError:
+        create_log("IncrementalSync can be either True or False", "red")
+        exit()
+
+    full_sync_interval = None
+    try:
+        full_sync_interval = config("FullSyncInterval", default=3600, cast=int)
+    except ValueError:
+        create_log("Value of FullSyncInterval must be a number", "red")
+        exit()
+
+    two_way = None
+    try:
+        two_way = config("TwoWaySync", default=False, cast=bool)
+    except ValueError:
+        create_log("TwoWaySync can be either True or False", "red")
+        exit()
+
+    # the edits made in google are only found through the calendar change feed
+    if two_way and not incremental_sync:
+        create_log("TwoWaySync needs IncrementalSync", "red")
+        exit()
+
 
     google_reminder = None
     try:
@@ -46,96 +119,844 @@ def main():
         create_log("GoogleReminderTime must be a number", "red")
         exit()
 
+    body_cache_size = None
+    try:
+        body_cache_size = config("BodyCacheSize", default=1000, cast=int)
+    except ValueError:
+        create_log("Value of BodyCacheSize must be a number", "red")
+        exit()
+
+    persist_body_cache = None
+    try:
+        persist_body_cache = config("PersistBodyCache", default=False, cast=bool)
+    except ValueError:
+        create_log("PersistBodyCache can be either True or False", "red")
+        exit()
+
+    metrics_port = None
+    try:
+        metrics_port = config("MetricsPort", default=0, cast=int)
+    except ValueError:
+        create_log("Value of MetricsPort must be a number", "red")
+        exit()
+
+    workers = None
+    try:
+        workers = config("Workers", default=8, cast=int)
+    except ValueError:
+        create_log("Value of Workers must be a number", "red")
+        exit()
+
+    notion_rate = None
+    google_rate = None
+    max_retries = None
+    try:
+        notion_rate = config("NotionRequestsPerSecond", default=3, cast=float)
+        google_rate = config("GoogleRequestsPerSecond", default=10, cast=float)
+        max_retries = config("MaxRetries", default=5, cast=int)
+    except ValueError:
+        create_log("NotionRequestsPerSecond, GoogleRequestsPerSecond and MaxRetries must be numbers", "red")
+        exit()
+
+    sync_pairs_file = config("SyncPairs", default="")
+    lease_file = config("LeaseFile", default="sync_leases.db")
+
+    lease_duration = None
+    try:
+        lease_duration = config("LeaseDuration", default=60, cast=float)
+    except ValueError:
+        create_log("Value of LeaseDuration must be a number", "red")
+        exit()
+
+    # the .env describes the only sync pair, or the defaults of the pairs listed in SyncPairs
+    defaults = {"Name": "default",
+                "ClientSecret": user_secret,
+                "DatabaseId": database_id,
+                "TitleHeader": title_header,
+                "DateHeader": date_header,
+                "CalendarName": calendar_name,
+                "GoogleReminder": google_reminder,
+                "GoogleReminderTime": google_reminder_time,
+                "StateFile": state_file}
+    pairs = load_sync_pairs(sync_pairs_file, defaults) if sync_pairs_file else [defaults]
+
     # validates the existence of the vars
-    check_env_vars(database_id, date_header, title_header, user_secret)
+    for pair in pairs:
+        check_env_vars(pair["DatabaseId"], pair["DateHeader"], pair["TitleHeader"], pair["ClientSecret"])
+
+    # a pair's StateFile holds its journal, queued writes, sync token and watermark, the worker that takes the
+    # pair over has to find them where the last one left them
+    if worker:
+        for pair in pairs:
+            if not on_same_storage(pair["StateFile"], lease_file):
+                create_log(f"StateFile of '{pair['Name']}' must be on the same storage as the LeaseFile "
+                           f"when running as a worker", "red")
+                exit(-1)
+
+    # Optional Prometheus endpoint
+    if metrics_port:
+        metrics.start_server(metrics_port)
+
+    # Every request to Notion and Google shares these rate limits, retry rules and connections,
+    # pairs using the same Notion token share its rate limit
+    scheduler = RequestScheduler(notion_rate=notion_rate,
+                                 google_rate=google_rate,
+                                 max_retries=max_retries)
+
+    # a dry run is a single cycle already
+    if once and not dry_run:
+        return run_once(pairs, scheduler, body_cache_size, persist_body_cache, workers, incremental_sync,
+                        full_sync_interval, two_way)
+
+    # the Google login and client take longer to import than everything else together, so they are only imported
+    # once a sync needs them, which a --once run that finds nothing to do never does
+    from google_credentials import CredentialManager
+
+    # One Google login for every pair, refreshed in the background
+    credentials = CredentialManager()
+    credentials.start()
+
+    if worker:
+        # the pairs are shared out between every worker using the same LeaseFile, each builds only its own
+        jobs = {pair["Name"]: partial(run_leased_sync, pair, scheduler, credentials.credentials, body_cache_size,
+                                      persist_body_cache, workers, sleep_freq, max_sleep_freq, poll_jitter,
+                                      incremental_sync, full_sync_interval, two_way)
+                for pair in pairs}
+        Worker(SyncState(state_location=lease_file), jobs, lease_duration=lease_duration).run()
+        return
+
+    syncs = [create_sync(pair, scheduler, credentials.credentials, body_cache_size, persist_body_cache, dry_run)
+             for pair in pairs]
+
+    if backfill_from is not None:
+        for google, notion, state in syncs:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                run_backfill(google, notion, state, pool, backfill_from,
+                             backfill_until or datetime.today().strftime("%Y-%m-%d"),
+                             backfill_window_days, backfill_parallel, dry_run)
+        return
+
+    if dry_run:
+        for google, notion, state in syncs:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                sync_cycle(google, notion, state, pool, incremental_sync, full_sync_interval, dry_run=True)
+        return
+
+    # every pair polls on its own thread with its own workers, so a huge database only holds up its own cycle
+    # and never has more than Workers requests waiting for the shared rate limits
+    threads = []
+    for pair, (google, notion, state) in zip(pairs, syncs):
+        thread = threading.Thread(target=run_sync,
+                                  name=pair["Name"],
+                                  args=(google, notion, state, workers, sleep_freq, max_sleep_freq, poll_jitter,
+                                        incremental_sync, full_sync_interval, two_way),
+                                  daemon=True)
+        thread.start()
+        threads.append(thread)
+
+    # the pairs sync until the process is stopped, a thread only ends if its setup failed
+    for thread in threads:
+        thread.join()
+    create_log("Every sync pair stopped", "red")
+    return 1
+
+
+# builds the state, Notion and Google of one sync pair
+# a dry run leaves a missing Message_ID field and calendar to be created by the real one
+def create_sync(pair, scheduler, credentials, body_cache_size, persist_body_cache, dry_run=False):
+    create_log(f"Setting up sync pair '{pair['Name']}'", "green")
+
+    # Local record of what was already pushed to Google
+    state = SyncState(state_location=pair["StateFile"])
+
+    notion = create_notion(pair, scheduler, state, body_cache_size, persist_body_cache, dry_run)
+    google = create_google(pair, scheduler, credentials, state, dry_run)
+
+    return google, notion, state
+
+
+def create_notion(pair, scheduler, state, body_cache_size, persist_body_cache, dry_run=False):
+    # Page bodies only need to be downloaded again after the page is edited
+    body_cache = BodyCache(max_size=body_cache_size,
+                           state=state if persist_body_cache else None)
 
     # Create Notion and validates it
-    notion = Notion(user_secret=user_secret,
-                    database_id=database_id,
-                    title_header=title_header,
-                    date_header=date_header,
-                    message_id_header="Message_ID")
+    notion = Notion(user_secret=pair["ClientSecret"],
+                    database_id=pair["DatabaseId"],
+                    title_header=pair["TitleHeader"],
+                    date_header=pair["DateHeader"],
+                    message_id_header="Message_ID",
+                    body_cache=body_cache,
+                    scheduler=scheduler,
+                    warm_cache=state,
+                    write_queue=state,
+                    read_only=dry_run)
+    return notion
 
+
+def create_google(pair, scheduler, credentials, state, dry_run=False):
     # Create Google and validates it
-    google = Google(calender_name=calendar_name,
-                    calender_reminder=google_reminder,
-                    calender_reminder_time=google_reminder_time)
+    return Google(calender_name=pair["CalendarName"],
+                  calender_reminder=pair["GoogleReminder"],
+                  calender_reminder_time=pair["GoogleReminderTime"],
+                  scheduler=scheduler,
+                  credentials=credentials,
+                  warm_cache=state,
+                  read_only=dry_run)
+
+
+# one sync cycle of every pair, for cron and the like, returns the exit status, 0 if every pair was synced
+# and 1 if one of them failed, what failed is tried again by the next run
+def run_once(pairs, scheduler, body_cache_size, persist_body_cache, workers, incremental_sync, full_sync_interval,
+             two_way) -> int:
+    status = 0
+    credentials = None
+    for pair in pairs:
+        state = SyncState(state_location=pair["StateFile"])
+        notion = None
+        try:
+            notion = create_notion(pair, scheduler, state, body_cache_size, persist_body_cache)
+            # Message_IDs left by an earlier run only need Notion
+            notion.start_writes()
+
+            # the probe of main_loop, with what the last run saw kept in the state, unfinished creates
+            # always need a cycle, as their events have to be looked up in Google
+            probe = time.time()
+            edited = notion.get_last_edited_time() if incremental_sync and not two_way else None
+
+            if is_unchanged(edited, state.get_value("once_last_edited"), float(state.get_value("once_last_probe", 0))) \
+                    and not needs_full_sweep(state, incremental_sync, full_sync_interval) \
+                    and not state.get_journal_entries():
+                create_log(f"Nothing changed in '{pair['Name']}'", "green")
+                synced = True
+            else:
+                if credentials is None:
+                    from google_credentials import CredentialManager
+                    credentials = CredentialManager().credentials
+                google = create_google(pair, scheduler, credentials, state)
+                synced = sync_once(google, notion, state, workers, incremental_sync, full_sync_interval, two_way)
+
+                # a failed cycle leaves the probe alone, so the next run has a cycle too, whose query reads the
+                # failed pages again as the watermark was kept at the oldest of them
+                if synced and edited is not None:
+                    state.set_value("once_last_edited", edited)
+                    state.set_value("once_last_probe", probe)
+
+            if not notion.flush_writes():
+                create_log(f"Some pages of '{pair['Name']}' are not linked to their events yet", "yellow")
+                synced = False
+        except OSError as error:
+            create_log(f"There was an error sending request to the website, details='{error}'", "red")
+            synced = False
+        except Exception as error:
+            # e.g. an HttpError Google answered with, the other pairs are still synced
+            create_log(f"Syncing '{pair['Name']}' failed, reason {error!r}", "red")
+            synced = False
+        finally:
+            if notion is not None:
+                notion.stop_writes()
+            state.close()
+
+        if not synced:
+            status = 1
+    return status
+
+
+# returns if the cycle synced everything
+def sync_once(google, notion, state, workers, incremental_sync, full_sync_interval, two_way) -> bool:
+    import httplib2
+
+    try:
+        recover_journal(google, notion, state)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            counts = sync_cycle(google, notion, state, pool, incremental_sync, full_sync_interval, two_way=two_way)
+    except (OSError, httplib2.HttpLib2Error) as error:
+        create_log(f"There was an error sending request to the website, details='{error}'", "red")
+        return False
+
+    return not counts["failed"] and not counts["aborted"]
+
+
+# runs one sync pair for as long as this worker holds its lease
+def run_leased_sync(pair, scheduler, credentials, body_cache_size, persist_body_cache, workers, sleep_freq,
+                    max_sleep_freq, poll_jitter, incremental_sync, full_sync_interval, two_way, lease):
+    google, notion, state = create_sync(pair, scheduler, credentials, body_cache_size, persist_body_cache)
+    try:
+        run_sync(google, notion, state, workers, sleep_freq, max_sleep_freq, poll_jitter,
+                 incremental_sync, full_sync_interval, two_way, lease)
+    finally:
+        notion.stop_writes()
+        state.close()
+
+
+def run_sync(google, notion, state, workers, sleep_freq, max_sleep_freq, poll_jitter,
+             incremental_sync, full_sync_interval, two_way=False, lease=None):
+    # the Message_IDs are written to Notion in the background, so the Google writes never wait on them
+    notion.start_writes()
+    recover_journal(google, notion, state)
+
+    # Pages are handled in parallel, the steps of a single page still run in order
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # Polls every Frequency seconds while pages change, backing off to MaxFrequency while they do not
+        poller = AdaptivePoller(min_interval=sleep_freq, max_interval=max_sleep_freq, jitter=poll_jitter)
+
+        main_loop(google, notion, state, pool, poller, incremental_sync, full_sync_interval, two_way, lease)
+
+
+# 'lease' is set in worker mode, the loop ends once it is no longer held
+def main_loop(google, notion, state, pool, poller, incremental_sync, full_sync_interval, two_way=False,
+              lease=None):
+    import httplib2
+
+    last_edited = None
+    last_probe = None
+    while lease is None or lease.held():
+        try:
+            # cheap probe of the most recent edit, so an idle database costs one small query per cycle,
+            # in two-way mode the calendar can change too, so every cycle reads both change feeds instead
+            probe = time.time()
+            edited = notion.get_last_edited_time() if incremental_sync and not two_way else None
+
+            if is_unchanged(edited, last_edited, last_probe) \
+                    and not needs_full_sweep(state, incremental_sync, full_sync_interval):
+                changed = False
+                metrics.inc("sync_skipped_cycles_total", help_text="Cycles skipped because nothing changed in notion")
+            else:
+                counts = sync_cycle(google, notion, state, pool, incremental_sync, full_sync_interval,
+                                    two_way=two_way, lease=lease)
+                if counts["failed"] or counts["aborted"]:
+                    # the failed work is retried by the next cycle, so this probe must not make it look idle
+                    last_edited, last_probe = None, None
+                else:
+                    last_edited, last_probe = edited, probe
+                changed = any(count for action, count in counts.items() if action != "skips")
+
+        except (OSError, httplib2.HttpLib2Error) as error:
+            # a network blip only costs this cycle, everything that was set up is kept
+            create_log(f"There was an error sending request to the website, details='{error}'", "red")
+            changed = True
+        except Exception as error:
+            # e.g. an HttpError Google answered with, the other pairs keep running, so this one has to as well
+            create_log(f"Cycle of '{threading.current_thread().name}' failed, reason {error!r}", "red")
+            changed = True
+
+        sleep_freq = poller.next_interval(changed)
+        create_log(f"Finished syncing '{threading.current_thread().name}', going sleep for {sleep_freq:.0f}", "green",
+                   level=logging.DEBUG)
+        if lease is None:
+            sleep(sleep_freq)
+        else:
+            lease.wait(sleep_freq)
+
+
+# true if the newest edit is the one already seen by the last cycle, and no other edit
+# could have happened in its minute after that cycle's probe
+def is_unchanged(edited, last_edited, last_probe) -> bool:
+    if edited is None or last_edited is None:
+        return False
+    return edited == last_edited and unchanged_since(edited, last_probe)
+
+
+# reads both sides, plans what has to change and applies it, a dry run only prints the plan,
+# returns how many pages and events each action handled
+def sync_cycle(google, notion, state, pool, incremental_sync, full_sync_interval, dry_run=False, two_way=False,
+               lease=None) -> Counter:
+    started = time.perf_counter()
+    with metrics.timer("sync_cycle_seconds", help_text="Duration of a whole sync cycle"):
+        counts = run_cycle(google, notion, state, pool, incremental_sync, full_sync_interval, dry_run, two_way, lease)
+    duration = time.perf_counter() - started
+
+    if counts["aborted"]:
+        metrics.inc("sync_aborted_cycles_total", help_text="Cycles cut short because notion could not be read")
+    for action, count in counts.items():
+        if action == "aborted":
+            continue
+        metrics.inc("sync_pages_total", {"action": action}, count, "Pages and events handled by the sync, by action")
+
+    # one line per cycle, the single events are only logged at debug level
+    summary = ", ".join(f"{count} {action}" for action, count in counts.items() if count)
+    create_log(f"Synced '{threading.current_thread().name}' in {duration:.1f}s: {summary or 'nothing to do'}",
+               "red" if counts["failed"] else "green",
+               fields=dict(counts, event="cycle", seconds=round(duration, 3)))
+    return counts
+
+
+def run_cycle(google, notion, state, pool, incremental_sync, full_sync_interval, dry_run, two_way=False,
+              lease=None) -> Counter:
+    counts = Counter()
+    # a dry run collects the whole plan to print it, a real one only keeps the pages it is writing
+    dry_run_plan = SyncPlan() if dry_run else None
+
+    with phase_timer("fetch"):
+        full_sweep = needs_full_sweep(state, incremental_sync, full_sync_interval)
+
+        # a dry run lists the calendar instead of moving the sync token forward
+        google_event_ids, google_changes, sync_token = get_google_events(google, state,
+                                                                         incremental_sync and not dry_run, two_way)
+
+    # pages whose event was edited in google wait for the pull, which decides which side wins
+    changed_events = {event["id"] for event in google_changes}
+    deferred = []
+    linked = set()
+    newest_edit = None
+    failed_edits = []
+
+    try:
+        # every chunk of pages is planned and written while the next page of results downloads
+        for chunk in timed_pulls(chunked(get_notion_events(notion, state, full_sweep), PAGES_PER_CHUNK),
+                                 "notion_fetch"):
+            ready = []
+            for notion_event in chunk:
+                if notion_event.msg_id:
+                    linked.add(notion_event.msg_id)
+                if newest_edit is None or notion_event.last_edited > newest_edit:
+                    newest_edit = notion_event.last_edited
+                (deferred if notion_event.msg_id in changed_events else ready).append(notion_event)
+
+            if not apply_plan(google, notion, state, pool, create_plan(ready, state), counts,
+                              dry_run_plan, lease, failed_edits):
+                return counts
+    except NotionError:
+        # without every page each event would look unlinked, and the watermark could pass edits it never saw
+        create_log("Skipping the rest of this cycle, could not read the notion database", "yellow")
+        counts["aborted"] += 1
+        return counts
+
+    if google_changes:
+        if lease is not None and not lease.held():
+            create_log("Lost the lease before writing, leaving the changes to the next owner", "yellow")
+            return counts
+
+        with phase_timer("pull"):
+            pushed, failed_pulls = pull_google_changes(google, notion, state, deferred, google_changes, counts)
+        # the pages held back are read again by the next cycle, with the Google edit they missed
+        failed_edits.extend(notion_event.last_edited for notion_event in deferred if notion_event.id in failed_pulls)
+        deferred = pushed
+    else:
+        failed_pulls = set()
+
+    if not apply_plan(google, notion, state, pool, create_plan(deferred, state), counts, dry_run_plan,
+                      lease, failed_edits):
+        return counts
+
+    # only moved once the changed events were handled, so a crash or failed pull reads them again, pulling an
+    # event twice changes nothing, as google_updated tells the second time it was already pulled
+    if sync_token is not None and not failed_pulls:
+        state.set_value("google_sync_token", sync_token)
+
+    with phase_timer("delete_reconcile"):
+        # the full sweep reads every linked page in one query, so pages that moved out of the date filter are
+        # still found, in between the pages the state has synced stand in for it, a page deleted in notion
+        # keeps its event until the next full sweep
+        notion_message_ids = set()
+        if find_unlinked_events(google_event_ids, linked):
+            notion_message_ids = notion.get_message_ids() if full_sweep else state.get_page_event_ids()
+            if notion_message_ids is None:
+                create_log("Skipping the delete check, could not read the notion database", "yellow")
+            else:
+                # the events of unfinished creates belong to a page, even though it does not link to them yet
+                notion_message_ids |= {event_id for page_id, event_id in state.get_journal_entries()}
 
-    main_loop(google, notion, sleep_freq)
+        plan = plan_deletes(google_event_ids, linked, notion_message_ids)
 
+    if not apply_plan(google, notion, state, pool, plan, counts, dry_run_plan, lease):
+        return counts
 
-def main_loop(google, notion, sleep_freq):
+    if dry_run:
+        print_plan(dry_run_plan)
+        return counts
+
+    # only move the watermark once the edits were handled, so a crash re-reads them, and no further than the
+    # oldest page whose write failed, the next query includes the pages edited at the watermark so it retries them
+    if full_sweep:
+        state.set_value("notion_last_full_sync", time.time())
+    if failed_edits:
+        newest_edit = min(failed_edits)
+    update_notion_watermark(state, newest_edit)
+
+    return counts
+
+
+# writes the plan, or adds it to the one a dry run prints, false if another worker took the pair over,
+# the last_edited of the pages whose write failed is added to 'failed_edits'
+def apply_plan(google, notion, state, pool, plan, counts, dry_run_plan=None, lease=None, failed_edits=None) -> bool:
+    if dry_run_plan is not None:
+        counts.update(plan.counts())
+        dry_run_plan.extend(plan)
+        return True
+
+    if lease is not None and not lease.held():
+        create_log("Lost the lease before writing, leaving the changes to the next owner", "yellow")
+        return False
+
+    writes, failures = execute_plan(google, notion, state, pool, plan)
+    # a planned patch that would not change the event is not sent, so it counts as a skip
+    done = plan.counts()
+    unchanged = done["patches"] - sum(1 for write in writes if write["method"] == "patch")
+    done["patches"] -= unchanged
+    done["skips"] += unchanged
+    counts.update(done)
+    counts["failed"] += len(failures)
+    if failed_edits is not None:
+        failed_edits.extend(item["notion_event"].last_edited for item in plan.creates + plan.patches + plan.unlinks
+                            if item["notion_event"].id in failures)
+    return True
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
     while True:
-        notion_events = notion.get_database()
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def phase_timer(phase):
+    return metrics.timer("sync_phase_seconds", {"phase": phase}, "Duration of each phase of a sync cycle")
+
+
+# the time spent waiting on the items of 'iterable', recorded as one phase once the loop over it ends, so the
+# planning and writing in between is left out
+def timed_pulls(iterable, phase):
+    iterator = iter(iterable)
+    waited = 0
+    try:
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                waited += time.perf_counter() - started
+            yield item
+    finally:
+        metrics.observe("sync_phase_seconds", waited, {"phase": phase}, "Duration of each phase of a sync cycle")
+
+
+def print_plan(plan):
+    for line in plan.describe():
+        create_log(line, "yellow")
+
+    counts = ", ".join(f"{count} {name}" for name, count in plan.counts().items())
+    cost = plan.estimate_requests()
+    create_log(f"Dry run: {counts}", "green")
+    create_log(f"Dry run: up to {cost['notion']} notion requests, {cost['google_calls']} google calendar calls "
+               f"in {cost['google_batches']} batch requests", "green")
+
+
+# syncs the pages dated from 'date_from' until 'date_until' (exclusive), 'window_days' at a time with 'parallel'
+# windows in flight, every finished window is recorded in the state so an interrupted backfill carries on from there
+def run_backfill(google, notion, state, pool, date_from, date_until, window_days, parallel, dry_run=False):
+    if not dry_run:
+        notion.start_writes()
+        recover_journal(google, notion, state)
+
+    windows = create_windows(date_from, date_until, window_days)
+    pending = [window for window in windows if state.get_value(backfill_key(window)) is None]
+    create_log(f"Backfilling {date_from} until {date_until}, {len(windows) - len(pending)} of {len(windows)} "
+               f"windows already done", "green")
+
+    with ThreadPoolExecutor(max_workers=parallel) as window_pool:
+        done = sum(window_pool.map(partial(backfill_window, google, notion, state, pool, dry_run), pending))
+
+    if dry_run:
+        return
+    if not notion.flush_writes(timeout=600):
+        create_log("Some pages are not linked to their events yet, the next run links them", "yellow")
+    notion.stop_writes()
+
+    if done == len(pending):
+        create_log("Backfill finished", "green")
+    else:
+        create_log(f"Backfilled {done} of {len(pending)} windows, run it again to retry the rest", "yellow")
+
 
-        for notion_event in notion_events:
-            handle_notion_event(google, notion, notion_event)
+# returns if the window is done
+def backfill_window(google, notion, state, pool, dry_run, window) -> bool:
+    date_from, date_until = window
+    counts = Counter()
+    dry_run_plan = SyncPlan() if dry_run else None
 
-        check_if_delete_event(google, notion)
+    try:
+        for chunk in chunked(notion.get_database(date_from=date_from, date_until=date_until), PAGES_PER_CHUNK):
+            # deletes are left to the regular sync, which knows every page
+            apply_plan(google, notion, state, pool, create_plan(chunk, state), counts, dry_run_plan)
+    except NotionError:
+        create_log(f"Could not read the pages from {date_from} until {date_until}", "red")
+        return False
+
+    if dry_run:
+        create_log(f"Dry run of {date_from} until {date_until}:", "green")
+        print_plan(dry_run_plan)
+        return False
+
+    if counts["failed"]:
+        create_log(f"{counts['failed']} events from {date_from} until {date_until} failed, not marking it done",
+                   "red")
+        return False
+
+    state.set_value(backfill_key(window), time.time())
+    create_log(f"Backfilled {date_from} until {date_until}, {sum(counts.values())} pages", "green")
+    return True
+
+
+# splits the days from 'date_from' until 'date_until' (exclusive) into (start, end) windows of 'days' days
+def create_windows(date_from: str, date_until: str, days: int) -> list:
+    start = datetime.strptime(date_from, "%Y-%m-%d")
+    until = datetime.strptime(date_until, "%Y-%m-%d")
+
+    windows = []
+    while start < until:
+        end = min(start + timedelta(days=days), until)
+        windows.append((start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d")))
+        start = end
+    return windows
+
+
+def backfill_key(window) -> str:
+    return f"backfill:{window[0]}:{window[1]}"
+
+
+def needs_full_sweep(state, incremental_sync, full_sync_interval) -> bool:
+    watermark = state.get_value("notion_watermark")
+    last_full_sync = float(state.get_value("notion_last_full_sync", 0))
+    return not incremental_sync or watermark is None or time.time() - last_full_sync >= full_sync_interval
+
+
+# gets only the pages edited since the last cycle, unless it is time for a full sweep
+def get_notion_events(notion, state, full_sweep):
+    if full_sweep:
+        return notion.get_database()
+    return notion.get_database(edited_since=state.get_value("notion_watermark"))
+
+
+def update_notion_watermark(state, newest_edit):
+    if newest_edit is None:
+        return
+
+    watermark = state.get_value("notion_watermark")
+    if watermark is None or newest_edit > watermark:
+        state.set_value("notion_watermark", newest_edit)
+
+
+# ids of the upcoming Google events, kept up to date from the calendar change feed in incremental mode,
+# with the changed events in two-way mode and the sync token to store once they are handled
+def get_google_events(google, state, incremental_sync, two_way=False):
+    if not incremental_sync:
+        return [event["id"] for event in google.get_events()], [], None
+
+    events, sync_token, full_sync = google.get_changed_events(state.get_value("google_sync_token"), details=two_way)
+    state.update_google_events(events, full_sync)
+
+    return state.get_google_event_ids(ends_after=time.time()), events if two_way else [], sync_token
+
+
+# writes the title and dates of the events edited in Google back to their pages, returns the pages that
+# are still pushed to Google, which leaves out the ones Google won, and the ids of the pages that could not be
+# updated, which are not pushed either, so the Google edit is not overwritten before it is pulled again
+def pull_google_changes(google, notion, state, notion_events, google_changes, counts=None):
+    edited_pages = {notion_event.id: notion_event for notion_event in notion_events}
+    failed = set()
+
+    for event in google_changes:
+        # the page decides when its event is deleted
+        if event.get("status") == "cancelled":
+            continue
+
+        # only events made by the sync have a page
+        synced = state.get_page_by_event(event["id"])
+        if synced is None:
+            continue
 
-        create_log(f"Finished syncing, going sleep for {sleep_freq}", "green")
-        sleep(sleep_freq)
+        # synced before two-way sync was turned on, the event as it is now is the starting point
+        if synced["google_updated"] is None:
+            state.save_page(synced["page_id"], synced["event_id"], synced["last_edited"], synced["fingerprint"],
+                            synced["checked_at"], event["updated"])
+            continue
 
+        # our own write, or a change that was already pulled
+        updated = parse_time(event["updated"])
+        if updated <= parse_time(synced["google_updated"]):
+            continue
 
-def handle_notion_event(google, notion, notion_event):
-    start_time = notion_event["due"]["start"]
-    end_time = notion_event["due"]["end"]
+        # edited on both sides, the newer edit wins, and the page wins if both were made in the same minute
+        notion_event = edited_pages.get(synced["page_id"])
+        if notion_event is not None and notion_event.last_edited != synced["last_edited"] \
+                and not unchanged_since(notion_event.last_edited, updated):
+            create_log(f"'{notion_event.title}' was edited in notion and google, keeping the notion edit", "yellow",
+                       level=logging.DEBUG)
+            continue
 
-    # create an event with start and end time
-    if start_time is not None and end_time is not None and not notion_event["msg_id"]:
-        create_event(google, notion, notion_event, start_time, end_time)
+        start, end = get_notion_dates(event)
+        page = notion.update_page(synced["page_id"], event.get("summary", ""), start, end)
+        if page is None:
+            failed.add(synced["page_id"])
+            if counts is not None:
+                counts["failed"] += 1
+            continue
 
-    # crete an event with only start time
-    elif start_time is not None and not notion_event["msg_id"]:
-        create_event(google, notion, notion_event, start_time, start_time)
+        create_log(f"Updated '{page.title}' in notion from google calendar", "green", level=logging.DEBUG)
+        metrics.inc("sync_pulled_changes_total", help_text="Google calendar edits written back to notion")
+        if counts is not None:
+            counts["pulled"] += 1
+        # the event already matches the page now, so the next push of it is skipped
+        pushed_event = google.build_event(page.title, event.get("description", ""), page.start, page.end or page.start)
+        state.save_page(page.id, event["id"], page.last_edited,
+                        create_fingerprint(pushed_event) if pushed_event != -1 else None,
+                        page.read_at, event["updated"])
+        edited_pages.pop(page.id, None)
 
-    # update an event with start and end time
-    elif notion_event["msg_id"] and start_time and end_time:
-        patch_event(google, notion, notion_event, start_time, end_time)
+    return [notion_event for notion_event in notion_events
+            if notion_event.id in edited_pages and notion_event.id not in failed], failed
+# returns the writes sent to Google, and the ones it refused by id
 
-    # update an event with only start time
-    elif notion_event["msg_id"] and start_time:
-        patch_event(google, notion, notion_event, start_time, start_time)
+# returns the writes Google refused, by id
+def execute_plan(google, notion, state, pool, plan):
+    writes = []
 
-    # Delete event if the notion event has MessageID but no longer the start and end time
-    if notion_event["msg_id"] and start_time is None and end_time is None:
-        delete_event(google, notion, notion_event)
+    # the bodies are read in parallel, each page adds its own write once it has one
+    with phase_timer("body"):
+        list(pool.map(partial(create_event, google, notion, state, writes), plan.creates))
+        list(pool.map(partial(patch_event, google, notion, state, writes), plan.patches))
 
+    for item in plan.unlinks:
+        delete_event(writes, item["notion_event"])
 
-def check_if_delete_event(google, notion):
-    # Check if the event was deleted in the notion
-    events = google.get_events()
-    for event in events:
-        exists_in_notion = notion.check_if_exists(event["id"])
-        if not exists_in_notion:
-            google.delete_event(event["id"])
+    for event_id in plan.deletes:
+        writes.append({"id": event_id, "method": "delete", "event_id": event_id})
 
+    with phase_timer("write"):
+        return writes, apply_writes(google, notion, state, pool, writes)
 
-def delete_event(google, notion, notion_event):
-    create_log(f"Deleting event'{notion_event}' because it has no start and end time", "yellow")
-    google.delete_event(notion_event["msg_id"])
-    notion.update_message_id("", notion_event["id"])
 
+def delete_event(writes, notion_event):
+    create_log(f"Deleting the event of '{notion_event.title}' because it has no start and end time", "yellow",
+               level=logging.DEBUG)
+    writes.append({"id": notion_event.id,
+                   "method": "delete",
+                   "event_id": notion_event.msg_id,
+                   "notion_event": notion_event})
 
-def patch_event(google, notion, notion_event, start, end):
-    body_text = notion.get_body(notion_event["id"])
-    google.patch_event(summary=notion_event["title"],
-                       description=body_text,
-                       start_time=start,
-                       end_time=end,
-                       event_id=notion_event["msg_id"])
 
+def patch_event(google, notion, state, writes, item):
+    notion_event = item["notion_event"]
+    body_text = notion.get_body(notion_event.id, notion_event.last_edited)
+    event = google.build_event(summary=notion_event.title,
+                               description=body_text,
+                               start_time=item["start"],
+                               end_time=item["end"])
+    if event == -1:
+        return
+    fingerprint = create_fingerprint(event)
 
-def create_event(google, notion, notion_event, start, end):
-    body_text = notion.get_body(notion_event["id"])
-    calendar_id = google.create_event(summary=notion_event["title"],
-                                      description=body_text,
-                                      start_time=start,
-                                      end_time=end)
-    if calendar_id == -1:
-        create_log(f"Time miss-match when creating event {notion_event['title']}", "red")
+    # edited, but not in a way that changes the event (e.g. our own Message_ID update)
+    synced = state.get_page(notion_event.id)
+    if synced is not None and synced["event_id"] == notion_event.msg_id and synced["fingerprint"] == fingerprint:
+        metrics.inc("sync_unchanged_patches_total", help_text="Patches skipped because the event would not change")
+        state.save_page(notion_event.id, notion_event.msg_id, notion_event.last_edited, fingerprint,
+                        notion_event.read_at)
+        return
+
+    writes.append({"id": notion_event.id,
+                   "method": "patch",
+                   "event_id": notion_event.msg_id,
+                   "event": event,
+                   "notion_event": notion_event,
+                   "fingerprint": fingerprint})
+
+
+def create_event(google, notion, state, writes, item):
+    notion_event = item["notion_event"]
+    body_text = notion.get_body(notion_event.id, notion_event.last_edited)
+    event = google.build_event(summary=notion_event.title,
+                               description=body_text,
+                               start_time=item["start"],
+                               end_time=item["end"])
+    if event == -1:
+        create_log(f"Time miss-match when creating event {notion_event.title}", "red")
     else:
-        notion.update_message_id(calendar_id, notion_event["id"])
+        fingerprint = create_fingerprint(event)
+        # the id is journaled before the insert is sent, an unfinished earlier create of the page is retried with
+        # the same id, which Google refuses to create twice
+        event["id"] = state.get_journal(notion_event.id)
+        if event["id"] is None:
+            event["id"] = create_event_id(notion_event.id)
+            state.add_journal(notion_event.id, event["id"])
+
+        writes.append({"id": notion_event.id,
+                       "method": "insert",
+                       "event": event,
+                       "notion_event": notion_event,
+                       "fingerprint": fingerprint})
+
+
+# sends the queued writes to Google in batches and records the outcome of each one in Notion and the state
+def apply_writes(google, notion, state, pool, writes):
+    if not writes:
+        return {}
+
+    results, failures = google.batch_write(writes)
+
+    list(pool.map(partial(record_write, notion, state, results, failures), writes))
+    return failures
+
+
+def record_write(notion, state, results, failures, write):
+    notion_event = write.get("notion_event")
+
+    if write["id"] in failures:
+        error = failures[write["id"]]
+        name = notion_event.title if notion_event is not None else write["event_id"]
+        create_log(f"Failed to {write['method']} the event for '{name}' "
+                   f"'{error.status_code}', reason {error.reason}", "red", key=f"write_failed:{error.status_code}")
+        # the journaled id belongs to an event that was deleted since, the next attempt starts over with a new one
+        if write["method"] == "insert" and error.status_code in (404, 410):
+            state.remove_journal(notion_event.id)
+
+    # an event whose page no longer exists
+    elif notion_event is None:
+        state.remove_google_event(write["event_id"])
+
+    elif write["method"] == "insert":
+        event = results[write["id"]]
+        create_log(f"Created event {write['event']['summary']}", "green", level=logging.DEBUG)
+        # the queued write keeps the link until Notion has it, which is all the journal was kept for,
+        # one sent right away that failed is linked from the journal by the next attempt
+        if not notion.queue_message_id(event["id"], notion_event.id, notion_event.msg_id or ""):
+            return
+        state.save_page(notion_event.id, event["id"], notion_event.last_edited, write["fingerprint"],
+                        notion_event.read_at, event.get("updated"))
+        state.remove_journal(notion_event.id)
+
+    elif write["method"] == "patch":
+        event = results[write["id"]] or {}
+        state.save_page(notion_event.id, write["event_id"], notion_event.last_edited, write["fingerprint"],
+                        notion_event.read_at, event.get("updated"))
+
+    # the event is deleted, the page still has to be unlinked from it, the next cycle tries again if it fails
+    elif notion.queue_message_id("", notion_event.id, notion_event.msg_id or ""):
+        state.remove_page(notion_event.id)
+
+
+# finishes the creates a crash left without a link to their page, and forgets the ones
+# that never reached Google, so nothing is created twice and nothing has to be reconciled
+def recover_journal(google, notion, state):
+    for page_id, event_id in state.get_journal_entries():
+        try:
+            event = google.get_event(event_id, fields="id,status")
+        except errors.HttpError as e:
+            if e.status_code not in (404, 410):
+                create_log(f"Could not check the unfinished event {event_id}, reason {e.reason}", "yellow")
+                continue
+            event = None
+
+        if event is None or event.get("status") == "cancelled":
+            state.remove_journal(page_id)
+        elif notion.queue_message_id(event_id, page_id):
+            create_log(f"Linked the unfinished event {event_id} to its page", "green")
+            state.remove_journal(page_id)
 
 
 def check_for_env_file():
@@ -155,15 +976,52 @@ def check_env_vars(database_id, date_header, title_header, user_secret):
         handle_missing_env_var("DateHeader")
 
 
+# true if both files are on the same filesystem, their folders are compared so the files do not have to exist yet
+def on_same_storage(path: str, other: str) -> bool:
+    try:
+        return os.stat(os.path.dirname(os.path.abspath(path))).st_dev == \
+            os.stat(os.path.dirname(os.path.abspath(other))).st_dev
+    except OSError:
+        return False
+
+
 def handle_missing_env_var(var_missing: str):
     create_log(f"'{var_missing}' missing in the .env", "red")
     exit(-1)
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sync a Notion database to a Google calendar.")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="print what one sync cycle would change, without writing anything")
+    # each of them runs the sync its own way
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--once", action="store_true",
+                      help="run one sync cycle and exit, with status 1 if something failed")
+    mode.add_argument("--worker", action="store_true",
+                      help="share the sync pairs with the other workers using the same LeaseFile")
+    mode.add_argument("--backfill", metavar="YYYY-MM-DD",
+                      help="sync the pages dated from this day until --backfill-until once, then stop")
+    parser.add_argument("--backfill-until", metavar="YYYY-MM-DD",
+                        help="first day the backfill leaves to the regular sync, default today")
+    parser.add_argument("--backfill-window-days", type=int, default=30,
+                        help="days queried and recorded as done at a time, default 30")
+    parser.add_argument("--backfill-parallel", type=int, default=4,
+                        help="windows queried at the same time, default 4")
+    args = parser.parse_args()
+
+    # a single run reports a failure through its exit status, the scheduler running it tries again
+    if args.once:
+        exit(main(dry_run=args.dry_run, once=True))
+
     while True:
         try:
-            main()
+            exit(main(dry_run=args.dry_run,
+                      worker=args.worker,
+                      backfill_from=args.backfill,
+                      backfill_until=args.backfill_until,
+                      backfill_window_days=args.backfill_window_days,
+                      backfill_parallel=args.backfill_parallel))
         except requests.exceptions.ConnectionError as error:
             create_log(f"There was an error sending request to the website, details='{error.request}'", "red")
             time.sleep(10)
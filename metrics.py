@@ -0,0 +1,112 @@
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from utilities import create_log
+
+
+class Metrics:
+    def __init__(self, buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)):
+        self.__BUCKETS = buckets
+
+        self.__Lock = threading.Lock()
+        self.__Counters = {}
+        self.__Histograms = {}
+        self.__Help = {}
+
+    def inc(self, name: str, labels: dict = None, value: float = 1, help_text: str = ""):
+        key = (name, self.__label_key(labels))
+        with self.__Lock:
+            self.__Help.setdefault(name, ("counter", help_text))
+            self.__Counters[key] = self.__Counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, labels: dict = None, help_text: str = ""):
+        key = (name, self.__label_key(labels))
+        with self.__Lock:
+            self.__Help.setdefault(name, ("histogram", help_text))
+            histogram = self.__Histograms.setdefault(key, {"buckets": [0] * len(self.__BUCKETS),
+                                                           "sum": 0,
+                                                           "count": 0})
+            for index, bound in enumerate(self.__BUCKETS):
+                if value <= bound:
+                    histogram["buckets"][index] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    # times the block and records it in the histogram 'name'
+    @contextmanager
+    def timer(self, name: str, labels: dict = None, help_text: str = ""):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, labels, help_text)
+
+    # the current values in the Prometheus text format
+    def render(self) -> str:
+        lines = []
+        with self.__Lock:
+            for name, (metric_type, help_text) in sorted(self.__Help.items()):
+                if help_text:
+                    lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {metric_type}")
+
+                if metric_type == "counter":
+                    for (key_name, labels), value in sorted(self.__Counters.items()):
+                        if key_name == name:
+                            lines.append(f"{name}{self.__format_labels(labels)} {value}")
+                    continue
+
+                for (key_name, labels), histogram in sorted(self.__Histograms.items()):
+                    if key_name != name:
+                        continue
+                    for bound, count in zip(self.__BUCKETS, histogram["buckets"]):
+                        lines.append(f"{name}_bucket{self.__format_labels(labels + (('le', str(bound)),))} {count}")
+                    lines.append(f"{name}_bucket{self.__format_labels(labels + (('le', '+Inf'),))} "
+                                 f"{histogram['count']}")
+                    lines.append(f"{name}_sum{self.__format_labels(labels)} {histogram['sum']}")
+                    lines.append(f"{name}_count{self.__format_labels(labels)} {histogram['count']}")
+
+        return "\n".join(lines) + "\n"
+
+    # serves the metrics on http://127.0.0.1:'port'/metrics from a background thread
+    def start_server(self, port: int, host: str = "127.0.0.1"):
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+
+                content = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        create_log(f"Serving metrics on http://{host}:{port}/metrics", "green")
+        return server
+
+    def __label_key(self, labels: dict) -> tuple:
+        return tuple(sorted((labels or {}).items()))
+
+    def __format_labels(self, labels: tuple) -> str:
+        if not labels:
+            return ""
+        return "{" + ",".join(f'{name}="{self.__escape(value)}"' for name, value in labels) + "}"
+
+    def __escape(self, value) -> str:
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+# shared by every module, like create_log
+metrics = Metrics()
@@ -1,38 +1,99 @@
 import json
+import threading
 import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
-import requests
 from datetime import datetime
-from termcolor import colored
+from urllib.parse import unquote
 
+from metrics import metrics
+from rate_limit import RequestScheduler
+from sync_state import unchanged_since
 from utilities import create_log
 
 
+# one row of the database, only what the sync reads of it
+NotionPage = namedtuple("NotionPage", ["id", "title", "start", "end", "msg_id", "last_edited", "read_at"])
+
+
+class NotionError(Exception):
+    pass
+
+
 class Notion:
     def __init__(self,
                  user_secret: str,
                  database_id: str,
                  title_header: str,
                  date_header: str,
-                 message_id_header: str):
+                 message_id_header: str,
+                 body_cache=None,
+                 scheduler=None,
+                 api_url="https://api.notion.com/v1",
+                 warm_cache=None,
+                 write_queue=None,
+                 write_retry=30,
+                 read_only=False):
 
         self.__UserSecret = user_secret
         self.__DatabaseId = database_id
         self.__TitleHeader = title_header
         self.__DateHeader = date_header
         self.__Message_IDHeader = message_id_header
+        self.__BodyCache = body_cache
+        self.__Scheduler = scheduler if scheduler is not None else RequestScheduler()
+
+        self.__ApiUrl = api_url
+
+        # SyncState keeping the validated database schema between starts
+        self.__WarmCache = warm_cache
+        self.__SchemaCached = False
+        # property name -> property id, used to only download the properties that are read
+        self.__PropertyIds = {}
+
+        # SyncState keeping the Message_ID writes Notion does not have yet, they are sent in the background
+        self.__WriteQueue = write_queue
+        self.__WRITE_RETRY = write_retry
+        self.__WritesQueued = threading.Event()
+        self.__StopWrites = threading.Event()
+        self.__WritesDone = threading.Condition()
+        self.__WriteThread = None
+
+        # a dry run reports the changes to the database instead of making them
+        self.__ReadOnly = read_only
 
         self.__NotionVersion = "2022-02-22"
         self.__Headers = {"Authorization": f"Bearer {user_secret}",
                           "Notion-Version": self.__NotionVersion}
 
-        self.check_database()
+        self.check_database(use_cache=True)
+
+    # every call to Notion goes through the scheduler, which keeps to the rate limit and retries
+    def __request(self, method: str, path: str, endpoint: str, **kwargs):
+        return self.__Scheduler.send("notion", method, f"{self.__ApiUrl}/{path}",
+                                     endpoint=endpoint,
+                                     budget=self.__UserSecret,
+                                     headers=self.__Headers,
+                                     **kwargs)
+
+    def check_database(self, use_cache=False):
+        # the properties seen last time are trusted until a query using them fails
+        cache_key = f"notion_schema:{self.__DatabaseId}"
+        self.__SchemaCached = False
+        if use_cache and self.__WarmCache is not None:
+            cached = json.loads(self.__WarmCache.get_value(cache_key, "null"))
+            # older versions cached only the names, without the ids
+            if isinstance(cached, dict) and {self.__DateHeader, self.__TitleHeader, self.__Message_IDHeader} <= set(
+                    cached):
+                self.__PropertyIds = cached
+                self.__SchemaCached = True
+                create_log("Notion database OK (cached).", "green")
+                return
 
-    def check_database(self):
         create_log("Checking notion database.", "yellow")
 
-        result = requests.get(f"https://api.notion.com/v1/databases/{self.__DatabaseId}",
-                              headers=self.__Headers)
+        result = self.__request("get", f"databases/{self.__DatabaseId}", "databases_get")
 
         if result.status_code != 200:
             create_log("There was a problem with getting Notion database!", "red")
@@ -45,12 +106,31 @@ class Notion:
             create_log("Notion database OK.", "green")
 
             if self.__Message_IDHeader not in prop:
-                self.create_header(self.__Message_IDHeader, "rich_text")
+                if self.__ReadOnly:
+                    # until it exists no page links to an event
+                    create_log(f"Dry run: would create the '{self.__Message_IDHeader}' field in the database",
+                               "yellow")
+                else:
+                    prop = self.create_header(self.__Message_IDHeader, "rich_text")
+
+            self.__PropertyIds = {name: value["id"] for name, value in prop.items()}
+            if self.__WarmCache is not None:
+                self.__WarmCache.set_value(cache_key, json.dumps(self.__PropertyIds))
 
         else:
             create_log("Invalid rows in Notion database", "red")
             exit(-1)
 
+    # a query rejected while the schema came from the cache checks the database again, once
+    def __revalidate_schema(self, response) -> bool:
+        if response.status_code != 400 or not self.__SchemaCached:
+            return False
+
+        create_log("Notion rejected the query, checking the database again.", "yellow")
+        self.check_database()
+        return True
+
+    # returns the properties of the database, the new one included
     def create_header(self, header, data_type):
         create_log("Creating MessageID field in database.", "yellow")
         data = {"properties": {
@@ -59,17 +139,26 @@ class Notion:
                     data_type: {}
                 }
         }}
-        result = requests.patch(f"https://api.notion.com/v1/databases/{self.__DatabaseId}",
-                                headers=self.__Headers,
-                                json=data)
+        result = self.__request("patch", f"databases/{self.__DatabaseId}", "databases_patch", json=data)
         if result.status_code != 200:
             create_log(f"Failed to add the '{header} with datatype '{data_type}' to the notion database!", "red")
             exit(-1)
         else:
             create_log(f"'{self.__Message_IDHeader}' field created in notion database.", "green")
-
-    def get_database(self) -> list:
-        today = datetime.today().strftime('%Y-%m-%d')
+            return result.json()["properties"]
+
+    # query parameters asking Notion for only these properties of each page,
+    # the ids come url encoded and requests encodes them again
+    def __only_properties(self, *headers) -> dict:
+        return {"filter_properties": [unquote(self.__PropertyIds[header]) for header in headers
+                                      if header in self.__PropertyIds]}
+
+    # yields the events from 'date_from' (today by default) onwards, until 'date_until' (exclusive) if it is given,
+    # only the ones edited since 'edited_since' if it is given, raises NotionError if the database could not be read,
+    # the next page of results is downloaded while the current one is handled
+    def get_database(self, edited_since: str = None, date_from: str = None, date_until: str = None):
+        if date_from is None:
+            date_from = datetime.today().strftime('%Y-%m-%d')
         rule = {
             "filter": {
                 "and": [
@@ -82,105 +171,317 @@ class Notion:
                     {
                         "property": self.__DateHeader,
                         "date": {
-                            "on_or_after": today
+                            "on_or_after": date_from
                         }
                     }
                 ]
             },
             "sorts": [
                 {
-                    "property": "Due",
+                    "property": self.__DateHeader,
                     "direction": "ascending"
                 }
-            ]
+            ],
+            "page_size": 100
         }
 
-        response = requests.post(url=f"https://api.notion.com/v1/databases/{self.__DatabaseId}/query",
-                                 headers=self.__Headers,
-                                 json=rule)
+        if date_until is not None:
+            rule["filter"]["and"].append({
+                "property": self.__DateHeader,
+                "date": {
+                    "before": date_until
+                }
+            })
 
-        if response.status_code != 200:
-            create_log("problem getting events from the database!", "red")
-            return []
+        if edited_since is not None:
+            rule["filter"]["and"].append({
+                "timestamp": "last_edited_time",
+                "last_edited_time": {
+                    "on_or_after": edited_since
+                }
+            })
 
-        data = response.json()
+        # taken before the query, so a write that lands while it runs is still seen on one side or the other
+        pending = self.__pending_message_ids()
 
-        events = []
-        for event in data["results"]:
-            title = event["properties"][self.__TitleHeader]["title"][0]["text"]["content"]
-            due = event["properties"][self.__DateHeader]["date"]
-            event_id = event["id"]
+        with ThreadPoolExecutor(max_workers=1) as prefetch:
+            next_page = prefetch.submit(self.__query_page, rule)
+            while True:
+                data, read_at = next_page.result()
+                if data.get("has_more"):
+                    next_page = prefetch.submit(self.__query_page, dict(rule, start_cursor=data["next_cursor"]))
 
-            msg_id = None
-            if len(event["properties"][self.__Message_IDHeader]["rich_text"]) > 0:
-                msg_id = event["properties"][self.__Message_IDHeader]["rich_text"][0]["text"]["content"]
+                for event in data["results"]:
+                    yield self.__parse_event(event, read_at, pending)
 
-            events.append({"title": title,
-                           "due": due,
-                           "msg_id": msg_id,
-                           "id": event_id})
-        return events
+                if not data.get("has_more"):
+                    return
 
-    def update_message_id(self, google_calendar_id: str, page_id: str):
+    def __query_page(self, rule: dict):
+        read_at = time.time()
+        response = self.__request("post", f"databases/{self.__DatabaseId}/query", "database_query", json=rule,
+                                  params=self.__only_properties(self.__TitleHeader, self.__DateHeader,
+                                                                self.__Message_IDHeader))
+
+        if response.status_code != 200:
+            if self.__revalidate_schema(response):
+                return self.__query_page(rule)
+            create_log("problem getting events from the database!", "red")
+            raise NotionError(f"query failed with {response.status_code}")
+
+        return response.json(), read_at
+
+    # 'pending' are the queued Message_ID writes, the page already counts as having them
+    def __parse_event(self, event, read_at: float, pending: dict = None) -> NotionPage:
+        title = event["properties"][self.__TitleHeader]["title"][0]["text"]["content"]
+        due = event["properties"][self.__DateHeader]["date"]
+        event_id = event["id"]
+        last_edited = event["last_edited_time"]
+
+        msg_id = None
+        rich_text = event["properties"].get(self.__Message_IDHeader, {}).get("rich_text", [])
+        if len(rich_text) > 0:
+            msg_id = rich_text[0]["text"]["content"]
+        if pending and event_id in pending:
+            msg_id = pending[event_id] or None
+
+        return NotionPage(id=event_id,
+                          title=title,
+                          start=due["start"] if due else None,
+                          end=due["end"] if due else None,
+                          msg_id=msg_id,
+                          last_edited=last_edited,
+                          read_at=read_at)
+
+    # the last_edited_time of the most recently edited page, one row is enough to tell if anything changed
+    def get_last_edited_time(self):
+        rule = {
+            "sorts": [
+                {
+                    "timestamp": "last_edited_time",
+                    "direction": "descending"
+                }
+            ],
+            "page_size": 1
+        }
+
+        # only last_edited_time is read, the smallest property keeps the answer small
+        response = self.__request("post", f"databases/{self.__DatabaseId}/query", "database_query", json=rule,
+                                  params=self.__only_properties(self.__Message_IDHeader))
+        if response.status_code != 200:
+            return None
+
+        results = response.json()["results"]
+        if not results:
+            return None
+        return results[0]["last_edited_time"]
+
+    # returns if the page was updated
+    def update_message_id(self, google_calendar_id: str, page_id: str) -> bool:
+        return self.__write_text(page_id, self.__Message_IDHeader, google_calendar_id).status_code == 200
+
+    # writes the Message_ID of the page in the background, 'current' is the one last read from the page ("" if it
+    # was empty), a write that would not change it is dropped, a newer one for the same page replaces the queued one,
+    # without a write queue it is sent right away, returns false if that failed
+    def queue_message_id(self, google_calendar_id: str, page_id: str, current: str = None) -> bool:
+        if self.__WriteQueue is None:
+            return self.update_message_id(google_calendar_id, page_id)
+
+        if google_calendar_id == current \
+                and self.__WriteQueue.get_pending_write(page_id, self.__Message_IDHeader) is None:
+            metrics.inc("sync_skipped_writes_total", help_text="Notion writes dropped because the page had the value")
+            return True
+
+        self.__WriteQueue.queue_write(page_id, self.__Message_IDHeader, google_calendar_id)
+        self.__WritesQueued.set()
+        return True
+
+    # sends the queued writes on a background thread, the ones left by an earlier run included
+    def start_writes(self):
+        if self.__WriteQueue is None or self.__WriteThread is not None:
+            return
+
+        self.__StopWrites.clear()
+        self.__WritesQueued.set()
+        self.__WriteThread = threading.Thread(target=self.__drain_writes, daemon=True,
+                                              name=f"{threading.current_thread().name}-writes")
+        self.__WriteThread.start()
+
+    # the write being sent is finished, the rest stay queued for the next start
+    def stop_writes(self):
+        if self.__WriteThread is None:
+            return
+
+        self.__StopWrites.set()
+        self.__WritesQueued.set()
+        self.__WriteThread.join()
+        self.__WriteThread = None
+
+    # waits until Notion has every queued write, false if some are still queued after 'timeout' seconds
+    def flush_writes(self, timeout: float = 60) -> bool:
+        if self.__WriteQueue is None:
+            return True
+
+        deadline = time.monotonic() + timeout
+        with self.__WritesDone:
+            while self.__WriteQueue.get_pending_writes():
+                remaining = deadline - time.monotonic()
+                if self.__WriteThread is None or remaining <= 0:
+                    return False
+                self.__WritesDone.wait(remaining)
+        return True
+
+    def __drain_writes(self):
+        while not self.__StopWrites.is_set():
+            # cleared before reading the queue, so a write queued while this pass runs starts the next one
+            self.__WritesQueued.clear()
+
+            # one at a time, Notion's rate limit is what holds them up, not the round trips
+            failed = False
+            for page_id, prop, value in self.__WriteQueue.get_pending_writes():
+                if self.__StopWrites.is_set():
+                    break
+                failed |= not self.__send_write(page_id, prop, value)
+
+            with self.__WritesDone:
+                self.__WritesDone.notify_all()
+
+            # new writes are sent right away, failed ones are tried again a while later
+            self.__WritesQueued.wait(self.__WRITE_RETRY if failed else None)
+
+    # returns false if the write has to be tried again
+    def __send_write(self, page_id: str, prop: str, value: str) -> bool:
+        try:
+            response = self.__write_text(page_id, prop, value)
+        except OSError as error:
+            create_log(f"Could not reach notion to write the {prop} of {page_id}, reason {error}", "yellow",
+                       key="notion_write_unreachable")
+            return False
+
+        # a deleted or archived page is never going to take it, any other refusal, like one for a renamed Message_ID
+        # property, stays queued until it is fixed, as dropping it would lose the link to the event
+        if response.status_code in (200, 404) or (response.status_code == 400 and "archived" in response.text):
+            self.__WriteQueue.remove_pending_write(page_id, prop, value)
+            return True
+        return False
+
+    def __write_text(self, page_id: str, prop: str, value: str):
         data = {
             "properties": {
-                self.__Message_IDHeader: {"rich_text": [{"text": {"content": google_calendar_id}}]}
+                prop: {"rich_text": [{"text": {"content": value}}]}
             }
         }
-        response = requests.patch(url=f"https://api.notion.com/v1/pages/{page_id}",
-                                  headers=self.__Headers,
-                                  json=data)
+        response = self.__request("patch", f"pages/{page_id}", "pages_patch", json=data)
 
         if response.status_code != 200:
-            create_log(f"Notion failed to update the {self.__Message_IDHeader}!", "red")
-            exit(-1)
-
-    def get_body(self, page_id: str):
-        body_text = ""
-        response = requests.get(url=f"https://api.notion.com/v1/blocks/{page_id}/children",
-                                headers=self.__Headers)
+            create_log(f"Notion failed to update the {prop} of {page_id}, reason {response.text}", "red",
+                       key=f"notion_write_failed:{response.status_code}")
+        return response
+
+    def __pending_message_ids(self) -> dict:
+        if self.__WriteQueue is None:
+            return {}
+        return self.__WriteQueue.get_pending_values(self.__Message_IDHeader)
+
+    # writes the title and dates of an event edited in Google back to the page,
+    # returns the page as Notion stored it, or None if the update failed
+    def update_page(self, page_id: str, title: str, start: str, end: str = None):
+        data = {
+            "properties": {
+                self.__TitleHeader: {"title": [{"text": {"content": title}}]},
+                self.__DateHeader: {"date": {"start": start, "end": end}}
+            }
+        }
+        read_at = time.time()
+        pending = self.__pending_message_ids()
+        response = self.__request("patch", f"pages/{page_id}", "pages_patch", json=data)
 
-        if response is not None:
-            try:
-                body = json.loads(response.text)
-                for ob in body["results"]:
-                    try:
-                        body_text += ob["paragraph"]["text"][0]["text"]["content"] + "\n"
-                    except IndexError:
-                        continue
-                    except KeyError:
-                        continue
-            except json.decoder.JSONDecodeError:
-                pass
+        if response.status_code != 200:
+            create_log(f"Notion failed to update the page '{title}', reason {response.text}", "red")
+            return None
+        return self.__parse_event(response.json(), read_at, pending)
+
+    # the text of the page, served from the body cache while the page has not been edited
+    def get_body(self, page_id: str, last_edited: str = None):
+        if self.__BodyCache is not None and last_edited is not None:
+            body_text = self.__BodyCache.get(page_id, last_edited)
+            if body_text is not None:
+                return body_text
+
+        read_at = time.time()
+        body_text, complete = self.__read_body(page_id)
+
+        # a body that was only partly read is not cached, so the next call tries again, neither is one read
+        # in the minute of the last edit, as another edit in that minute would not change last_edited_time
+        if complete and self.__BodyCache is not None and last_edited is not None \
+                and unchanged_since(last_edited, read_at):
+            self.__BodyCache.put(page_id, last_edited, body_text)
 
         return body_text
 
-    def check_if_exists(self, event_id: str) -> bool:
+    # reads the paragraphs one page of blocks at a time, returns the text and if every block was read
+    def __read_body(self, page_id: str):
+        lines = []
+        params = {"page_size": 100}
+
+        while True:
+            response = self.__request("get", f"blocks/{page_id}/children", "block_children", params=params)
+
+            try:
+                body = json.loads(response.text)
+                blocks = body["results"]
+            except (json.decoder.JSONDecodeError, KeyError):
+                return "".join(lines), False
+
+            for ob in blocks:
+                paragraph = ob.get("paragraph")
+                if paragraph is None:
+                    continue
+
+                # 'text' was renamed to 'rich_text' in newer Notion versions
+                spans = paragraph.get("rich_text", paragraph.get("text", []))
+                if len(spans) > 0:
+                    lines.append("".join(span["text"]["content"] if "text" in span else span.get("plain_text", "")
+                                         for span in spans) + "\n")
+
+            if not body.get("has_more"):
+                return "".join(lines), True
+            params["start_cursor"] = body["next_cursor"]
+
+    # all the Message_IDs in the database, past ones included, or None if notion could not be read
+    def get_message_ids(self):
         rule = {
             "filter": {
                 "property": self.__Message_IDHeader,
                 "rich_text": {
-                    "equals": event_id
+                    "is_not_empty": True
                 }
-            }
+            },
+            "page_size": 100
         }
 
-        while True:
-            response = requests.post(url=f"https://api.notion.com/v1/databases/{self.__DatabaseId}/query",
-                                     headers=self.__Headers,
-                                     json=rule)
-
-            if response.status_code == 400:
-                return False
+        # the queued ones are going to be in the database, so their events are still linked
+        message_ids = {value for value in self.__pending_message_ids().values() if value}
+        # a dry run on a database without the field yet
+        if self.__Message_IDHeader not in self.__PropertyIds:
+            return message_ids
 
-            # there as an error
-            try:
-                response = json.loads(response.text)
-            except json.decoder.JSONDecodeError:
-                time.sleep(1)
-                continue
-
-            if not response["results"]:
-                return False
-            else:
-                return True
+        while True:
+            response = self.__request("post", f"databases/{self.__DatabaseId}/query", "database_query", json=rule,
+                                      params=self.__only_properties(self.__Message_IDHeader))
+
+            if response.status_code != 200:
+                if self.__revalidate_schema(response):
+                    return self.get_message_ids()
+                create_log("problem getting the message ids from the database!", "red")
+                return None
+
+            data = response.json()
+            for event in data["results"]:
+                rich_text = event["properties"][self.__Message_IDHeader]["rich_text"]
+                if len(rich_text) > 0:
+                    message_ids.add(rich_text[0]["text"]["content"])
+
+            if not data.get("has_more"):
+                return message_ids
+            rule["start_cursor"] = data["next_cursor"]
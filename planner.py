@@ -0,0 +1,106 @@
+import math
+
+from sync_state import unchanged_since
+
+
+class SyncPlan:
+    def __init__(self):
+        # pages without an event yet
+        self.creates = []
+        # linked pages edited since the last push, the executor still skips them if the payload did not change
+        self.patches = []
+        # linked pages whose date was removed, their event is deleted and the Message_ID cleared
+        self.unlinks = []
+        # ids of Google events whose page no longer exists
+        self.deletes = []
+        # pages that were not edited since the last push
+        self.skips = []
+
+    # adds the pages of a plan made for a later part of the database
+    def extend(self, plan):
+        self.creates.extend(plan.creates)
+        self.patches.extend(plan.patches)
+        self.unlinks.extend(plan.unlinks)
+        self.deletes.extend(plan.deletes)
+        self.skips.extend(plan.skips)
+
+    def counts(self) -> dict:
+        return {"creates": len(self.creates),
+                "patches": len(self.patches),
+                "unlinks": len(self.unlinks),
+                "deletes": len(self.deletes),
+                "skips": len(self.skips)}
+
+    # the most requests applying the plan can cost, body fetches served from the cache cost nothing
+    def estimate_requests(self, batch_limit=50) -> dict:
+        google_writes = len(self.creates) + len(self.patches) + len(self.unlinks) + len(self.deletes)
+        return {"notion": len(self.creates) + len(self.patches) + len(self.creates) + len(self.unlinks),
+                "google_calls": google_writes,
+                "google_batches": math.ceil(google_writes / batch_limit)}
+
+    def describe(self) -> list:
+        lines = []
+        for item in self.creates:
+            lines.append(f"create '{item['notion_event'].title}' {item['start']} -> {item['end']}")
+        for item in self.patches:
+            lines.append(f"patch  '{item['notion_event'].title}' {item['start']} -> {item['end']}")
+        for item in self.unlinks:
+            lines.append(f"unlink '{item['notion_event'].title}' event {item['notion_event'].msg_id}")
+        for event_id in self.deletes:
+            lines.append(f"delete event {event_id}")
+        return lines
+
+
+# decides what has to happen to every page, without sending any request
+def create_plan(notion_events, state) -> SyncPlan:
+    plan = SyncPlan()
+
+    for notion_event in notion_events:
+        plan_page(plan, state, notion_event)
+
+    return plan
+
+
+# decides which Google events are deleted, 'linked' are the Message_IDs of the pages read this cycle and
+# 'notion_message_ids' the ones of the whole database, None when they could not be read, then nothing is deleted
+def plan_deletes(google_event_ids, linked, notion_message_ids) -> SyncPlan:
+    plan = SyncPlan()
+
+    if notion_message_ids is not None:
+        plan.deletes = sorted(find_unlinked_events(google_event_ids, linked) - notion_message_ids)
+
+    return plan
+
+
+def plan_page(plan, state, notion_event):
+    start_time = notion_event.start
+    end_time = notion_event.end
+
+    # Delete event if the notion event has MessageID but no longer the start and end time
+    if start_time is None:
+        if notion_event.msg_id and end_time is None:
+            plan.unlinks.append({"notion_event": notion_event})
+        return
+
+    # an event with only start time ends when it starts
+    item = {"notion_event": notion_event,
+            "start": start_time,
+            "end": end_time if end_time is not None else start_time}
+
+    if not notion_event.msg_id:
+        plan.creates.append(item)
+        return
+
+    # the page was not edited since the last push, so nothing in the event can have changed
+    synced = state.get_page(notion_event.id)
+    if synced is not None and synced["event_id"] == notion_event.msg_id \
+            and synced["last_edited"] == notion_event.last_edited \
+            and unchanged_since(synced["last_edited"], synced["checked_at"]):
+        plan.skips.append(item)
+    else:
+        plan.patches.append(item)
+
+
+# Google events not linked to any of the pages read, only these need looking up in the whole database
+def find_unlinked_events(google_event_ids, linked) -> set:
+    return set(google_event_ids) - set(linked)
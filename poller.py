@@ -0,0 +1,22 @@
+import random
+
+
+class AdaptivePoller:
+    def __init__(self, min_interval=60, max_interval=600, jitter=0.1, backoff=2):
+        self.__MIN_INTERVAL = min_interval
+        self.__MAX_INTERVAL = max(min_interval, max_interval)
+        self.__JITTER = jitter
+        self.__BACKOFF = backoff
+
+        self.__Interval = min_interval
+
+    # seconds to wait before the next cycle, short while things change and growing while they do not
+    def next_interval(self, changed: bool) -> float:
+        if changed:
+            self.__Interval = self.__MIN_INTERVAL
+        else:
+            self.__Interval = min(self.__MAX_INTERVAL, self.__Interval * self.__BACKOFF)
+
+        # spread out so several syncs started together do not keep polling together
+        spread = self.__Interval * self.__JITTER
+        return max(0, self.__Interval + random.uniform(-spread, spread))
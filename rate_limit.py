@@ -0,0 +1,162 @@
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from googleapiclient import errors
+
+from metrics import metrics
+from utilities import create_log
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = None):
+        self.__RATE = rate
+        self.__CAPACITY = capacity if capacity is not None else max(rate, 1)
+
+        self.__Lock = threading.Lock()
+        self.__Tokens = self.__CAPACITY
+        self.__Updated = time.monotonic()
+
+    # takes 'tokens' from the bucket, waiting for them if needed, returns how long it waited
+    def acquire(self, tokens: float = 1) -> float:
+        with self.__Lock:
+            now = time.monotonic()
+            self.__Tokens = min(self.__CAPACITY, self.__Tokens + (now - self.__Updated) * self.__RATE)
+            self.__Updated = now
+
+            # the tokens are taken right away, so callers are served in the order they arrived
+            self.__Tokens -= tokens
+            wait = -self.__Tokens / self.__RATE if self.__Tokens < 0 else 0
+
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class RequestScheduler:
+    def __init__(self,
+                 notion_rate=3,
+                 google_rate=10,
+                 max_retries=5,
+                 base_delay=1,
+                 max_delay=60,
+                 pool_size=32):
+        self.__Rates = {"notion": notion_rate,
+                        "google": google_rate}
+        # one bucket per service and budget, every sync pair using the same token shares one
+        self.__Buckets = {}
+        self.__BucketsLock = threading.Lock()
+
+        # kept alive between requests and shared by every sync pair
+        self.__Session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.__Session.mount("https://", adapter)
+        self.__Session.mount("http://", adapter)
+
+        self.__MAX_RETRIES = max_retries
+        self.__BASE_DELAY = base_delay
+        self.__MAX_DELAY = max_delay
+
+        # Notion answers 409 when two writes to the same page collide
+        self.__NOTION_RETRY_STATUSES = (409, 429, 500, 502, 503, 504)
+        self.__GOOGLE_RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    # sends a request to a plain HTTP api like Notion, retrying rate limits and server errors,
+    # 'endpoint' names the call in the metrics, 'budget' is the rate limit it counts against (e.g. the token)
+    def send(self, service: str, method: str, url: str, endpoint: str = "other", budget: str = None, **kwargs):
+        attempt = 0
+        while True:
+            self.acquire(service, budget=budget)
+            started = time.perf_counter()
+            try:
+                response = self.__Session.request(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                self.__record(service, endpoint, "connection_error", started)
+                if attempt >= self.__MAX_RETRIES:
+                    raise
+                self.__retry(service, endpoint, attempt)
+                attempt += 1
+                continue
+
+            self.__record(service, endpoint, response.status_code, started)
+            if response.status_code not in self.__NOTION_RETRY_STATUSES or attempt >= self.__MAX_RETRIES:
+                return response
+
+            self.__retry(service, endpoint, attempt, response.headers.get("Retry-After"))
+            attempt += 1
+
+    # runs a googleapiclient request (or batch), 'tokens' is how many calls it counts for in the quota
+    def execute(self, service: str, request, tokens: int = 1, budget: str = None):
+        # e.g. calendar.events.insert, a batch has no method of its own
+        endpoint = getattr(request, "methodId", None) or "batch"
+
+        attempt = 0
+        while True:
+            self.acquire(service, tokens, budget)
+            started = time.perf_counter()
+            try:
+                result = request.execute()
+            except errors.HttpError as e:
+                self.__record(service, endpoint, e.status_code, started)
+                if not self.is_retryable(e) or attempt >= self.__MAX_RETRIES:
+                    raise
+                self.__retry(service, endpoint, attempt, e.resp.get("retry-after"))
+                attempt += 1
+                continue
+
+            self.__record(service, endpoint, 200, started)
+            return result
+
+    def __record(self, service: str, endpoint: str, status, started: float):
+        labels = {"service": service, "endpoint": endpoint}
+        metrics.observe("sync_request_seconds", time.perf_counter() - started, labels,
+                        "Latency of the requests to Notion and Google")
+        metrics.inc("sync_requests_total", dict(labels, status=str(status)),
+                    help_text="Requests sent to Notion and Google")
+
+    def __retry(self, service: str, endpoint: str, attempt: int, retry_after=None):
+        metrics.inc("sync_request_retries_total", {"service": service, "endpoint": endpoint},
+                    help_text="Requests sent again after a rate limit or error")
+        self.backoff(service, attempt, retry_after)
+
+    def is_retryable(self, error) -> bool:
+        if error.status_code in self.__GOOGLE_RETRY_STATUSES:
+            return True
+        # Google reports most of its rate limits as 403
+        return error.status_code == 403 and b"ateLimitExceeded" in error.content
+
+    def acquire(self, service: str, tokens: int = 1, budget: str = None) -> float:
+        waited = self.__get_bucket(service, budget).acquire(tokens)
+        if waited:
+            metrics.inc("sync_rate_limit_wait_seconds_total", {"service": service, "reason": "token_bucket"}, waited,
+                        "Time spent waiting for the rate limits")
+        return waited
+
+    def __get_bucket(self, service: str, budget: str = None) -> TokenBucket:
+        with self.__BucketsLock:
+            bucket = self.__Buckets.get((service, budget))
+            if bucket is None:
+                bucket = self.__Buckets[(service, budget)] = TokenBucket(self.__Rates[service])
+            return bucket
+
+    # waits before the next attempt, honouring Retry-After when the server sent one
+    def backoff(self, service: str, attempt: int, retry_after=None) -> float:
+        delay = None
+        if retry_after is not None:
+            try:
+                delay = float(retry_after)
+            except ValueError:
+                delay = None
+
+        if delay is None:
+            # full jitter, so the threads that were limited together do not retry together
+            delay = random.uniform(0, min(self.__MAX_DELAY, self.__BASE_DELAY * 2 ** attempt))
+
+        create_log(f"Request to {service} failed or was rate limited, retrying in {delay:.1f} seconds", "yellow",
+                   key=f"backoff:{service}")
+        metrics.inc("sync_rate_limit_wait_seconds_total", {"service": service, "reason": "backoff"}, delay,
+                    "Time spent waiting for the rate limits")
+        time.sleep(delay)
+        return delay
@@ -0,0 +1,61 @@
+import json
+import os
+
+from utilities import create_log
+
+# the settings a sync pair can set for itself, anything left out is taken from the .env
+PAIR_SETTINGS = ("ClientSecret", "DatabaseId", "TitleHeader", "DateHeader", "CalendarName",
+                 "GoogleReminder", "GoogleReminderTime", "StateFile")
+
+
+# reads the sync pairs from a json list like
+# [{"Name": "work", "DatabaseId": "...", "CalendarName": "work"}, {"Name": "home", ...}]
+def load_sync_pairs(location: str, defaults: dict) -> list:
+    if not os.path.exists(location):
+        create_log(f"'{location}' is missing!", "red")
+        exit(-1)
+
+    try:
+        with open(location) as file:
+            entries = json.load(file)
+    except ValueError as error:
+        create_log(f"'{location}' is not valid json, reason {error}", "red")
+        exit(-1)
+
+    if not isinstance(entries, list) or not entries:
+        create_log(f"'{location}' must be a list with at least one sync pair", "red")
+        exit(-1)
+
+    pairs = []
+    names = set()
+    for index, entry in enumerate(entries):
+        if not isinstance(entry, dict):
+            create_log(f"Sync pair {index} in '{location}' must be an object", "red")
+            exit(-1)
+
+        name = str(entry.get("Name", index))
+        unknown = set(entry) - set(PAIR_SETTINGS) - {"Name"}
+        if unknown:
+            create_log(f"Sync pair '{name}' has unknown settings {', '.join(sorted(unknown))}", "red")
+            exit(-1)
+        if name in names:
+            create_log(f"Sync pair name '{name}' is used twice", "red")
+            exit(-1)
+        names.add(name)
+
+        pair = dict(defaults, Name=name)
+        # every pair keeps its own state, unless it names the file itself
+        root, extension = os.path.splitext(defaults["StateFile"])
+        pair["StateFile"] = f"{root}_{name}{extension}"
+        pair.update(entry)
+
+        if not isinstance(pair["GoogleReminder"], bool):
+            create_log(f"GoogleReminder of sync pair '{name}' can be either true or false", "red")
+            exit(-1)
+        if not isinstance(pair["GoogleReminderTime"], int):
+            create_log(f"GoogleReminderTime of sync pair '{name}' must be a number", "red")
+            exit(-1)
+
+        pairs.append(pair)
+
+    return pairs
@@ -0,0 +1,306 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+
+from utilities import create_log
+
+
+class SyncState:
+    def __init__(self, state_location='sync_state.db'):
+        self.__STATE_LOCATION = state_location
+        self.__Lock = threading.Lock()
+
+        # other worker processes may be writing to the same file, so wait for their locks a while
+        self.__Connection = sqlite3.connect(self.__STATE_LOCATION, timeout=30, check_same_thread=False)
+        self.__Connection.row_factory = sqlite3.Row
+
+        self.__create_tables()
+        create_log(f"Sync state loaded from '{self.__STATE_LOCATION}'.", "green")
+
+    def __create_tables(self):
+        with self.__Lock, self.__Connection:
+            self.__Connection.execute("""
+                CREATE TABLE IF NOT EXISTS pages (
+                    page_id     TEXT PRIMARY KEY,
+                    event_id    TEXT NOT NULL,
+                    last_edited TEXT,
+                    fingerprint TEXT,
+                    checked_at  REAL,
+                    google_updated TEXT
+                )""")
+            # state files from before two-way sync
+            columns = [row["name"] for row in self.__Connection.execute("PRAGMA table_info(pages)")]
+            if "google_updated" not in columns:
+                self.__Connection.execute("ALTER TABLE pages ADD COLUMN google_updated TEXT")
+            self.__Connection.execute("CREATE INDEX IF NOT EXISTS pages_event_id ON pages (event_id)")
+            self.__Connection.execute("""
+                CREATE TABLE IF NOT EXISTS google_events (
+                    event_id TEXT PRIMARY KEY,
+                    ends_at  REAL
+                )""")
+            self.__Connection.execute("""
+                CREATE TABLE IF NOT EXISTS bodies (
+                    page_id     TEXT PRIMARY KEY,
+                    last_edited TEXT,
+                    body        TEXT
+                )""")
+            self.__Connection.execute("""
+                CREATE TABLE IF NOT EXISTS meta (
+                    key   TEXT PRIMARY KEY,
+                    value TEXT
+                )""")
+            self.__Connection.execute("""
+                CREATE TABLE IF NOT EXISTS journal (
+                    page_id    TEXT PRIMARY KEY,
+                    event_id   TEXT NOT NULL,
+                    started_at REAL NOT NULL
+                )""")
+            self.__Connection.execute("""
+                CREATE TABLE IF NOT EXISTS pending_writes (
+                    page_id   TEXT NOT NULL,
+                    property  TEXT NOT NULL,
+                    value     TEXT NOT NULL,
+                    queued_at REAL NOT NULL,
+                    PRIMARY KEY (page_id, property)
+                )""")
+            self.__Connection.execute("""
+                CREATE TABLE IF NOT EXISTS leases (
+                    job        TEXT PRIMARY KEY,
+                    owner      TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                )""")
+            self.__Connection.execute("""
+                CREATE TABLE IF NOT EXISTS workers (
+                    owner      TEXT PRIMARY KEY,
+                    expires_at REAL NOT NULL
+                )""")
+
+    # returns what was last pushed to Google for the page, or None if it was never synced
+    def get_page(self, page_id: str):
+        with self.__Lock:
+            row = self.__Connection.execute("SELECT * FROM pages WHERE page_id = ?", (page_id,)).fetchone()
+
+        if row is None:
+            return None
+        return dict(row)
+
+    def get_page_by_event(self, event_id: str):
+        with self.__Lock:
+            row = self.__Connection.execute("SELECT * FROM pages WHERE event_id = ?", (event_id,)).fetchone()
+
+        if row is None:
+            return None
+        return dict(row)
+
+    # 'checked_at' is when the page was read from Notion, see unchanged_since, 'google_updated' is the
+    # updated time Google gave the event for our last write to it, the stored one is kept if it is None
+    def save_page(self, page_id: str, event_id: str, last_edited: str, fingerprint: str, checked_at: float,
+                  google_updated: str = None):
+        with self.__Lock, self.__Connection:
+            self.__Connection.execute("""
+                INSERT INTO pages (page_id, event_id, last_edited, fingerprint, checked_at, google_updated)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(page_id) DO UPDATE SET
+                    event_id = excluded.event_id,
+                    last_edited = excluded.last_edited,
+                    fingerprint = excluded.fingerprint,
+                    checked_at = excluded.checked_at,
+                    google_updated = COALESCE(excluded.google_updated, pages.google_updated)""",
+                                      (page_id, event_id, last_edited, fingerprint, checked_at, google_updated))
+
+    def remove_page(self, page_id: str):
+        with self.__Lock, self.__Connection:
+            self.__Connection.execute("DELETE FROM pages WHERE page_id = ?", (page_id,))
+            self.__Connection.execute("DELETE FROM bodies WHERE page_id = ?", (page_id,))
+
+    # ids of the events the synced pages link to
+    def get_page_event_ids(self) -> set:
+        with self.__Lock:
+            rows = self.__Connection.execute("SELECT event_id FROM pages").fetchall()
+        return {row["event_id"] for row in rows}
+
+    # the stored body of the page, only if the page was not edited since
+    def get_body(self, page_id: str, last_edited: str):
+        with self.__Lock:
+            row = self.__Connection.execute("SELECT body FROM bodies WHERE page_id = ? AND last_edited = ?",
+                                            (page_id, last_edited)).fetchone()
+
+        if row is None:
+            return None
+        return row["body"]
+
+    def save_body(self, page_id: str, last_edited: str, body_text: str):
+        with self.__Lock, self.__Connection:
+            self.__Connection.execute("INSERT OR REPLACE INTO bodies (page_id, last_edited, body) VALUES (?, ?, ?)",
+                                      (page_id, last_edited, body_text))
+
+    # keeps the local copy of the calendar up to date from a Google change feed
+    def update_google_events(self, events: list, full_sync: bool):
+        with self.__Lock, self.__Connection:
+            if full_sync:
+                self.__Connection.execute("DELETE FROM google_events")
+
+            for event in events:
+                if event.get("status") == "cancelled":
+                    self.__Connection.execute("DELETE FROM google_events WHERE event_id = ?", (event["id"],))
+                else:
+                    self.__Connection.execute("INSERT OR REPLACE INTO google_events (event_id, ends_at) VALUES (?, ?)",
+                                              (event["id"], get_event_end(event)))
+
+    def remove_google_event(self, event_id: str):
+        with self.__Lock, self.__Connection:
+            self.__Connection.execute("DELETE FROM google_events WHERE event_id = ?", (event_id,))
+
+    # ids of the known Google events that end after 'ends_after' (unix time)
+    def get_google_event_ids(self, ends_after: float = 0) -> list:
+        with self.__Lock:
+            rows = self.__Connection.execute("SELECT event_id FROM google_events WHERE ends_at >= ?",
+                                             (ends_after,)).fetchall()
+        return [row["event_id"] for row in rows]
+
+    # small key/value store for things like watermarks and sync tokens
+    def get_value(self, key: str, default=None):
+        with self.__Lock:
+            row = self.__Connection.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+
+        if row is None:
+            return default
+        return row["value"]
+
+    def set_value(self, key: str, value):
+        with self.__Lock, self.__Connection:
+            self.__Connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    # the event id a create for the page was started with, None if no create is unfinished
+    def get_journal(self, page_id: str):
+        with self.__Lock:
+            row = self.__Connection.execute("SELECT event_id FROM journal WHERE page_id = ?", (page_id,)).fetchone()
+
+        if row is None:
+            return None
+        return row["event_id"]
+
+    # records that an event with 'event_id' is about to be created for the page, before it is sent
+    def add_journal(self, page_id: str, event_id: str):
+        with self.__Lock, self.__Connection:
+            self.__Connection.execute("INSERT OR REPLACE INTO journal (page_id, event_id, started_at) VALUES (?, ?, ?)",
+                                      (page_id, event_id, time.time()))
+
+    # the create was linked to its page, or never reached Google
+    def remove_journal(self, page_id: str):
+        with self.__Lock, self.__Connection:
+            self.__Connection.execute("DELETE FROM journal WHERE page_id = ?", (page_id,))
+
+    # (page_id, event_id) of every unfinished create
+    def get_journal_entries(self) -> list:
+        with self.__Lock:
+            rows = self.__Connection.execute("SELECT page_id, event_id FROM journal ORDER BY started_at").fetchall()
+        return [(row["page_id"], row["event_id"]) for row in rows]
+
+    # a newer value for the same property of the page replaces the one still waiting
+    def queue_write(self, page_id: str, prop: str, value: str):
+        with self.__Lock, self.__Connection:
+            self.__Connection.execute("""
+                INSERT OR REPLACE INTO pending_writes (page_id, property, value, queued_at)
+                VALUES (?, ?, ?, ?)""", (page_id, prop, value, time.time()))
+
+    # (page_id, property, value) of every write Notion does not have yet, oldest first
+    def get_pending_writes(self) -> list:
+        with self.__Lock:
+            rows = self.__Connection.execute("SELECT page_id, property, value FROM pending_writes "
+                                             "ORDER BY queued_at").fetchall()
+        return [(row["page_id"], row["property"], row["value"]) for row in rows]
+
+    # the value still waiting to be written to the property of the page, None if there is none
+    def get_pending_write(self, page_id: str, prop: str):
+        with self.__Lock:
+            row = self.__Connection.execute("SELECT value FROM pending_writes WHERE page_id = ? AND property = ?",
+                                            (page_id, prop)).fetchone()
+
+        if row is None:
+            return None
+        return row["value"]
+
+    # page_id -> value of the writes of one property that Notion does not have yet
+    def get_pending_values(self, prop: str) -> dict:
+        with self.__Lock:
+            rows = self.__Connection.execute("SELECT page_id, value FROM pending_writes WHERE property = ?",
+                                             (prop,)).fetchall()
+        return {row["page_id"]: row["value"] for row in rows}
+
+    # only removes the write if no newer value was queued while it was being sent
+    def remove_pending_write(self, page_id: str, prop: str, value: str):
+        with self.__Lock, self.__Connection:
+            self.__Connection.execute("DELETE FROM pending_writes WHERE page_id = ? AND property = ? AND value = ?",
+                                      (page_id, prop, value))
+
+    # takes the job for 'duration' seconds if it is free, its lease ran out or it is already ours,
+    # sqlite runs the statement on its own, so two workers can never both get it
+    def claim_lease(self, job: str, owner: str, duration: float) -> bool:
+        now = time.time()
+        with self.__Lock, self.__Connection:
+            cursor = self.__Connection.execute("""
+                INSERT INTO leases (job, owner, expires_at) VALUES (?, ?, ?)
+                ON CONFLICT(job) DO UPDATE SET
+                    owner = excluded.owner,
+                    expires_at = excluded.expires_at
+                WHERE leases.owner = excluded.owner OR leases.expires_at < ?""",
+                                               (job, owner, now + duration, now))
+        return cursor.rowcount == 1
+
+    def release_lease(self, job: str, owner: str):
+        with self.__Lock, self.__Connection:
+            self.__Connection.execute("DELETE FROM leases WHERE job = ? AND owner = ?", (job, owner))
+
+    # marks the worker as alive for 'duration' seconds
+    def register_worker(self, owner: str, duration: float):
+        with self.__Lock, self.__Connection:
+            self.__Connection.execute("INSERT OR REPLACE INTO workers (owner, expires_at) VALUES (?, ?)",
+                                      (owner, time.time() + duration))
+
+    def remove_worker(self, owner: str):
+        with self.__Lock, self.__Connection:
+            self.__Connection.execute("DELETE FROM workers WHERE owner = ?", (owner,))
+
+    def count_workers(self) -> int:
+        with self.__Lock, self.__Connection:
+            self.__Connection.execute("DELETE FROM workers WHERE expires_at < ?", (time.time(),))
+            return self.__Connection.execute("SELECT COUNT(*) FROM workers").fetchone()[0]
+
+    def close(self):
+        with self.__Lock:
+            self.__Connection.close()
+
+
+# hash of the Google event body a page is built into, used to skip patches that would change nothing,
+# the id is left out as inserts carry one and patches do not
+def create_fingerprint(event: dict) -> str:
+    fields = {key: value for key, value in event.items() if key != "id"}
+    payload = json.dumps(fields, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+# unix time of the end of a Google event, all-day events end at midnight UTC
+def get_event_end(event) -> float:
+    end = event.get("end", {})
+    if "dateTime" in end:
+        return parse_time(end["dateTime"])
+    if "date" in end:
+        return datetime.strptime(end["date"], "%Y-%m-%d").replace(tzinfo=timezone.utc).timestamp()
+    return 0
+
+
+def parse_time(moment: str) -> float:
+    return datetime.fromisoformat(moment.replace("Z", "+00:00")).timestamp()
+
+
+# Notion rounds last_edited_time down to the minute, so a page read at 'moment' is only certainly unchanged
+# while its last_edited_time stays the same if that minute had already ended when it was read
+def unchanged_since(last_edited: str, moment: float) -> bool:
+    if moment is None:
+        return False
+
+    return moment >= parse_time(last_edited) + 60
@@ -0,0 +1,142 @@
+from concurrent.futures import ThreadPoolExecutor
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+from google.auth.credentials import AnonymousCredentials
+
+from fake_apis import FakeGoogleCalendar, FakeNotion, notion_time
+from google_calender import Google
+from main import main_loop, sync_cycle
+from notion import Notion
+from poller import AdaptivePoller
+from rate_limit import RequestScheduler
+from sync_state import SyncState
+
+
+@pytest.fixture
+def sync(tmp_path):
+    notion_server = FakeNotion(size=3).start()
+    google_server = FakeGoogleCalendar().start()
+    state = SyncState(state_location=str(tmp_path / "sync_state.db"))
+    scheduler = RequestScheduler(notion_rate=1000, google_rate=1000)
+
+    notion = Notion(user_secret="test",
+                    database_id=notion_server.database_id,
+                    title_header="Task",
+                    date_header="Due",
+                    message_id_header="Message_ID",
+                    scheduler=scheduler,
+                    api_url=notion_server.api_url)
+    google = Google(calender_name="notion",
+                    scheduler=scheduler,
+                    credentials=AnonymousCredentials(),
+                    api_root=google_server.url)
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        yield SimpleNamespace(notion_server=notion_server, google_server=google_server, state=state,
+                              notion=notion, google=google, pool=pool)
+
+    state.close()
+    notion_server.stop()
+    google_server.stop()
+
+
+def run(sync, two_way=False):
+    return sync_cycle(sync.google, sync.notion, sync.state, sync.pool, incremental_sync=True,
+                      full_sync_interval=3600, two_way=two_way)
+
+
+def test_failed_write_is_retried_by_the_next_incremental_cycle(sync):
+    # creates the events, the second cycle moves the watermark past the Message_ID updates of the first
+    run(sync)
+    run(sync)
+
+    failing, other = list(sync.notion_server.pages.values())[:2]
+    now = datetime.utcnow()
+    failing["title"] += " edited"
+    failing["last_edited_time"] = notion_time(now)
+    other["title"] += " edited"
+    other["last_edited_time"] = notion_time(now + timedelta(minutes=2))
+
+    # Google refuses the patch of 'failing', the one of 'other' goes through and is the newest edit of the cycle
+    batch_write = sync.google.batch_write
+
+    def refuse_failing(operations):
+        results, failures = batch_write([operation for operation in operations if operation["id"] != failing["id"]])
+        failures[failing["id"]] = SimpleNamespace(status_code=503, reason="Backend Error")
+        return results, failures
+
+    sync.google.batch_write = refuse_failing
+    assert run(sync)["failed"] == 1
+
+    sync.google.batch_write = batch_write
+    assert run(sync)["failed"] == 0
+    assert sync.google_server.events[failing["msg_id"]]["summary"] == failing["title"]
+
+
+def test_unchanged_patch_counts_as_skip(sync):
+    run(sync)
+
+    # the Message_ID updates of the first cycle are edits, but they leave the events as they are
+    counts = run(sync)
+    assert counts["patches"] == 0
+    assert counts["skips"] == len(sync.notion_server.pages)
+
+
+def test_failed_pull_is_pulled_again_by_the_next_cycle(sync):
+    run(sync, two_way=True)
+    run(sync, two_way=True)
+
+    page = next(iter(sync.notion_server.pages.values()))
+    sync.google_server.edit_event(page["msg_id"], summary="Moved in google")
+
+    # Notion refuses the update of the page once
+    update_page = sync.notion.update_page
+    sync.notion.update_page = lambda *args: None
+    assert run(sync, two_way=True)["failed"] == 1
+
+    sync.notion.update_page = update_page
+    assert run(sync, two_way=True)["pulled"] == 1
+    assert page["title"] == "Moved in google"
+
+
+# stands in for a worker lease, holds for the given number of cycles and calls 'between' after each one
+class CycleLease:
+    def __init__(self, cycles, between):
+        self.cycles = cycles
+        self.between = between
+
+    def held(self):
+        return self.cycles > 0
+
+    def wait(self, seconds):
+        self.cycles -= 1
+        self.between()
+
+
+def test_main_loop_retries_a_failed_cycle_without_new_edits(sync, monkeypatch):
+    run(sync)
+    run(sync)
+
+    page = next(iter(sync.notion_server.pages.values()))
+    page["title"] += " edited"
+    page["last_edited_time"] = notion_time(datetime.utcnow())
+
+    batch_write = sync.google.batch_write
+
+    def refuse_all(operations):
+        return {}, {operation["id"]: SimpleNamespace(status_code=503, reason="Backend Error")
+                    for operation in operations}
+
+    def restore():
+        sync.google.batch_write = batch_write
+
+    # the second cycle probes after the minute of the edit, so nothing looks edited since the failed first one
+    monkeypatch.setattr("main.time", SimpleNamespace(time=lambda: time.time() + 120, perf_counter=time.perf_counter))
+    sync.google.batch_write = refuse_all
+    main_loop(sync.google, sync.notion, sync.state, sync.pool, AdaptivePoller(), incremental_sync=True,
+              full_sync_interval=3600, lease=CycleLease(2, restore))
+
+    assert sync.google_server.events[page["msg_id"]]["summary"] == page["title"]
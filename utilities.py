@@ -1,7 +1,117 @@
-from termcolor import colored
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
 from datetime import datetime
 
+from termcolor import colored
+
+LEVELS = {"red": logging.ERROR, "yellow": logging.WARNING, "green": logging.INFO}
+COLOURS = {logging.DEBUG: "white", logging.INFO: "green", logging.WARNING: "yellow", logging.ERROR: "red"}
+
+logger = logging.getLogger("notion_to_calendar")
+listener = None
+
+
+# queues the message for the logging thread, so a slow stdout never holds up the sync,
+# 'colour' also sets the level (red error, yellow warning, green info) unless 'level' is given,
+# messages with the same 'key' are only written once per repeat interval, 'fields' are added to json output
+def create_log(msg, colour, level=None, key=None, fields=None):
+    if listener is None:
+        setup_logging()
+
+    if level is None:
+        level = LEVELS.get(colour, logging.INFO)
+    if not logger.isEnabledFor(level):
+        return
+
+    logger.log(level, msg, extra={"colour": colour, "key": key, "fields": fields or {}})
+
+
+# 'log_format' is text or json, 'level' a logging level name like INFO
+def setup_logging(log_format="text", level="INFO", repeat_interval=60):
+    global listener
+    if listener is not None:
+        listener.stop()
+
+    handler = StdoutHandler()
+    handler.setFormatter(JsonFormatter() if log_format == "json" else TextFormatter())
+
+    messages = queue.SimpleQueue()
+    logger.handlers = [logging.handlers.QueueHandler(messages)]
+    logger.filters = [RepeatFilter(repeat_interval)]
+    logger.propagate = False
+    logger.setLevel(level)
+
+    listener = logging.handlers.QueueListener(messages, handler)
+    listener.start()
+
+
+# writes out what is still queued
+def stop_logging():
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
+
+
+atexit.register(stop_logging)
+
+
+class StdoutHandler(logging.StreamHandler):
+    # looks sys.stdout up on every write, so redirecting it still works
+    @property
+    def stream(self):
+        return sys.stdout
+
+    @stream.setter
+    def stream(self, value):
+        pass
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        time_stamp = datetime.fromtimestamp(record.created).strftime("%Y-%m-%d, %H:%M")
+        colour = getattr(record, "colour", None) or COLOURS.get(record.levelno, "white")
+        return colored(f"{time_stamp} -> {record.getMessage()}", colour)
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {"time": datetime.fromtimestamp(record.created).astimezone().isoformat(timespec="milliseconds"),
+                 "level": record.levelname.lower(),
+                 "thread": record.threadName,
+                 "message": record.getMessage()}
+        entry.update(getattr(record, "fields", {}))
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+# lets a message with a key through once per 'interval' seconds, the next one says how many were left out
+class RepeatFilter(logging.Filter):
+    def __init__(self, interval=60):
+        super().__init__()
+        self.__INTERVAL = interval
+
+        self.__Lock = threading.Lock()
+        self.__Seen = {}
+
+    def filter(self, record) -> bool:
+        key = getattr(record, "key", None)
+        if key is None:
+            return True
+
+        now = time.monotonic()
+        with self.__Lock:
+            last_time, skipped = self.__Seen.get(key, (None, 0))
+            if last_time is not None and now - last_time < self.__INTERVAL:
+                self.__Seen[key] = (last_time, skipped + 1)
+                return False
+            self.__Seen[key] = (now, 0)
 
-def create_log(msg, colour):
-    time_stamp = datetime.now().strftime("%Y-%m-%d, %H:%M")
-    print(colored(f"{time_stamp} -> {msg}", colour))
+        if skipped:
+            record.msg = f"{record.msg} (and {skipped} more like it)"
+        return True
@@ -0,0 +1,114 @@
+import math
+import os
+import socket
+import threading
+import time
+import uuid
+
+from utilities import create_log
+
+
+class Lease:
+    def __init__(self, store, job: str, owner: str, duration: float):
+        self.__Store = store
+        self.__Job = job
+        self.__Owner = owner
+        self.__DURATION = duration
+
+        self.__Stopping = threading.Event()
+        self.__Deadline = 0
+
+    def claim(self) -> bool:
+        # the deadline is counted from before the claim was sent, so it never outlives the one in the store
+        started = time.monotonic()
+        if not self.__Store.claim_lease(self.__Job, self.__Owner, self.__DURATION):
+            return False
+
+        self.__Deadline = started + self.__DURATION
+        return True
+
+    # false once the lease was given back, taken over or could not be renewed in time, nothing may be written then
+    def held(self) -> bool:
+        return not self.__Stopping.is_set() and time.monotonic() < self.__Deadline
+
+    def stop(self):
+        self.__Stopping.set()
+
+    def stopping(self) -> bool:
+        return self.__Stopping.is_set()
+
+    # sleeps like time.sleep, but wakes up as soon as the lease is stopped
+    def wait(self, seconds: float):
+        self.__Stopping.wait(seconds)
+
+    def release(self):
+        self.__Store.release_lease(self.__Job, self.__Owner)
+
+
+class Worker:
+    def __init__(self, store, jobs: dict, lease_duration=60):
+        # 'jobs' maps the name of each job to a function running it while the lease it gets is held
+        self.__Store = store
+        self.__Jobs = jobs
+        self.__LEASE_DURATION = lease_duration
+
+        self.__Owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.__Running = {}
+
+    # claims a fair share of the jobs, renews their leases and picks up jobs whose worker died, until stopped
+    def run(self):
+        create_log(f"Worker '{self.__Owner}' started, {len(self.__Jobs)} jobs", "green")
+        try:
+            while True:
+                self.__Store.register_worker(self.__Owner, self.__LEASE_DURATION)
+                self.__renew_leases()
+                self.__balance()
+                # renewed three times per lease, so one slow renewal does not lose it
+                time.sleep(self.__LEASE_DURATION / 3)
+        finally:
+            for lease, thread in self.__Running.values():
+                lease.stop()
+            self.__Store.remove_worker(self.__Owner)
+
+    def __renew_leases(self):
+        for job, (lease, thread) in list(self.__Running.items()):
+            # the job released its lease when it ended
+            if not thread.is_alive():
+                del self.__Running[job]
+            # a stopping job keeps its lease until it has really ended
+            elif not lease.claim():
+                create_log(f"Lost the lease of '{job}', stopping it", "yellow")
+                lease.stop()
+
+    def __balance(self):
+        share = math.ceil(len(self.__Jobs) / max(1, self.__Store.count_workers()))
+        active = sorted(job for job, (lease, thread) in self.__Running.items() if not lease.stopping())
+
+        # hands jobs back when other workers joined
+        for job in active[share:]:
+            create_log(f"Handing '{job}' over to another worker", "yellow")
+            self.__Running[job][0].stop()
+
+        claimed = len(active)
+        for job in sorted(self.__Jobs):
+            if claimed >= share:
+                break
+            if job in self.__Running:
+                continue
+
+            lease = Lease(self.__Store, job, self.__Owner, self.__LEASE_DURATION)
+            if lease.claim():
+                claimed += 1
+                create_log(f"Claimed '{job}'", "green")
+                thread = threading.Thread(target=self.__run_job, args=(job, lease), name=job, daemon=True)
+                self.__Running[job] = (lease, thread)
+                thread.start()
+
+    def __run_job(self, job: str, lease: Lease):
+        try:
+            self.__Jobs[job](lease)
+        except (Exception, SystemExit) as error:
+            create_log(f"Job '{job}' stopped, reason {error!r}", "red")
+        finally:
+            lease.stop()
+            lease.release()